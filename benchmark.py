@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+أداة قياس أداء ChatGPTPlus2FABot دون الاتصال بخوادم تيليجرام
+
+تشغّل تطبيق البوت الحقيقي (نفس المعالجات والمجدول وطابور الإرسال) أمام خادم Bot API
+وهمي محلي، وتحقن نقرات Copy Code اصطناعية بمعدل ثابت، ثم تطبع الإنتاجية وزمن المعالجة
+(p50/p99) وحجم الكتابة على القرص وانحراف المجدول. النتائج قابلة للتكرار باستخدام --seed.
+
+مثال:
+    python3 benchmark.py --groups 1000 --clicks-per-minute 10000 --duration 60
+    python3 benchmark.py --api-latency 50 --error-rate 0.01 --json > before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+import urllib.parse
+
+# يجب تحديد مجلد البيانات قبل استيراد البوت حتى لا تُمس ملفات الإنتاج
+DATA_DIR = tempfile.mkdtemp(prefix="bot-benchmark-")
+os.environ["BOT_DATA_DIR"] = DATA_DIR
+
+import bot  # noqa: E402
+from telegram import Update  # noqa: E402
+
+
+def percentile(values, fraction):
+    """النسبة المئوية بطريقة أقرب رتبة (0 لقائمة فارغة)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+
+class FakeBotApi:
+    """خادم Bot API وهمي مبني على MiniHttpServer مع زمن استجابة وأخطاء 429 قابلة للضبط"""
+
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.calls = {}
+        self.rate_limited = 0
+        self.group_deliveries = {}  # chat_id -> [أوقات الوصول]
+        self.server = bot.MiniHttpServer(self.handle, port=0, max_connections=1024)
+        self._message_id = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.port}/bot"
+
+    @staticmethod
+    def _params(headers, body):
+        if not body:
+            return {}
+        if headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode("utf-8")).items()}
+
+    def _reply(self, result=None, ok=True, **extra):
+        payload = {"ok": ok}
+        if ok:
+            payload["result"] = result
+        payload.update(extra)
+        return 200 if ok else extra.get("error_code", 400), "application/json", json.dumps(payload).encode()
+
+    async def handle(self, method, target, headers, body):
+        api_method = target.split("?", 1)[0].rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api_method == "getMe":
+            return self._reply({"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"})
+        if api_method in ("deleteWebhook", "setWebhook", "answerCallbackQuery"):
+            return self._reply(True)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.rate_limited += 1
+            return self._reply(
+                ok=False, error_code=429, description=f"Too Many Requests: retry after {self.retry_after}",
+                parameters={"retry_after": self.retry_after}
+            )
+
+        params = self._params(headers, body)
+        if api_method == "sendMessage":
+            chat_id = int(params.get("chat_id", 0))
+            if chat_id < 0:
+                self.group_deliveries.setdefault(chat_id, []).append(time.monotonic())
+            self._message_id += 1
+            return self._reply({
+                "message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                "text": params.get("text", "")
+            })
+        if api_method in ("editMessageText", "editMessageReplyMarkup"):
+            return self._reply(True)
+        return self._reply(ok=False, error_code=404, description="Not Found: method not found")
+
+
+def write_fixtures(groups, interval, seed):
+    """إنشاء config.json بعدد المجموعات المطلوب وأسرار TOTP عشوائية ثابتة"""
+    rng = random.Random(seed)
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZ234567"
+    config = {"groups": {}, "admins": [bot.ADMIN_ID]}
+    group_ids = []
+    for i in range(groups):
+        group_id = str(-1000000000000 - i)
+        group_ids.append(group_id)
+        config["groups"][group_id] = {
+            "totp_secret": "".join(rng.choice(alphabet) for _ in range(32)),
+            "interval": interval,
+            "message_style": 1,
+            "timezone": "UTC"
+        }
+    bot.save_config(config)
+    return group_ids
+
+
+def click_update(update_id, user_id, group_id):
+    """تحديث callback_query اصطناعي لزر Copy Code"""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat_instance": "benchmark",
+            "data": f"copy_code_{group_id}",
+            "message": {
+                "message_id": 1, "date": int(time.time()),
+                "chat": {"id": int(group_id), "type": "supergroup"}
+            }
+        }
+    }
+
+
+async def run(args):
+    api = FakeBotApi(args.api_latency / 1000, args.error_rate, args.retry_after, args.seed)
+    await api.server.start()
+    bot.TELEGRAM_BASE_URL = api.base_url
+    if args.global_rate:
+        bot.outbox = bot.OutboundQueue(global_rate=args.global_rate)
+    group_ids = write_fixtures(args.groups, args.interval, args.seed)
+
+    # قياس زمن المعالج وزمن الاستجابة الكلي (منذ وضع التحديث في الطابور)
+    enqueued = {}
+    handler_latency = []
+    end_to_end_latency = []
+    original_callback = bot.button_callback
+
+    async def timed_callback(update, context):
+        started = time.perf_counter()
+        try:
+            await original_callback(update, context)
+        finally:
+            finished = time.perf_counter()
+            handler_latency.append(finished - started)
+            queued_at = enqueued.pop(update.update_id, None)
+            if queued_at is not None:
+                end_to_end_latency.append(finished - queued_at)
+
+    bot.button_callback = timed_callback
+    application = bot.build_application()
+
+    rng = random.Random(args.seed)
+    await application.initialize()
+    await application.post_init(application)
+    # الموعد الأول الذي حدده المجدول لكل مجموعة (على الساعة الرتيبة)؛ القياس منه لا من لحظة
+    # التشغيل حتى لا يُحسب أي تأخير بدء يختاره المجدول (مثل نافذة الاستئناف) انحرافاً
+    offset = time.monotonic() - time.time()
+    first_due = {int(g): bot.scheduler.next_send_at(g) + offset for g in group_ids if g in bot.scheduler}
+    await application.start()
+
+    clicks = int(args.clicks_per_minute * args.duration / 60)
+    spacing = 60 / args.clicks_per_minute if args.clicks_per_minute else 0
+    started = time.perf_counter()
+    for n in range(clicks):
+        # مواعيد مطلقة حتى لا يتراكم تأخر الحقن
+        delay = started + n * spacing - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        update_id = n + 1
+        data = click_update(update_id, rng.randint(1, args.users), rng.choice(group_ids))
+        enqueued[update_id] = time.perf_counter()
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    remaining = args.duration - (time.perf_counter() - started)
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+
+    # انتظار انتهاء النقرات المعلقة (بحد أقصى --drain ثانية)
+    drain_deadline = time.perf_counter() + args.drain
+    while enqueued and time.perf_counter() < drain_deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    await application.stop()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+    await api.server.stop()
+
+    # الانحراف: وقت وصول الرسالة k لكل مجموعة مقارنة بموعدها الاسمي first_due + k * interval
+    drift = []
+    for chat_id, deliveries in api.group_deliveries.items():
+        for k, arrived in enumerate(deliveries):
+            drift.append(arrived - (first_due[chat_id] + k * args.interval))
+
+    # كل عمليات الكتابة: حفظ الملفات، سجل الكتابة المؤجلة، وإطارات WAL في SQLite
+    bytes_written = sum(
+        value for key, value in bot.metrics.sample("bot_storage_bytes_total").items()
+        if not dict(key)["op"].startswith("load_")
+    )
+    lateness = bot.metrics.sample("bot_scheduler_lateness_seconds").get((), ([], 0.0, 0))
+
+    return {
+        "config": vars(args),
+        "clicks_sent": clicks,
+        "clicks_completed": len(handler_latency),
+        "clicks_pending": len(enqueued),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_clicks_per_second": round(len(handler_latency) / elapsed, 2) if elapsed else 0,
+        "handler_latency_ms": {
+            "p50": round(percentile(handler_latency, 0.50) * 1000, 2),
+            "p99": round(percentile(handler_latency, 0.99) * 1000, 2),
+        },
+        "end_to_end_latency_ms": {
+            "p50": round(percentile(end_to_end_latency, 0.50) * 1000, 2),
+            "p99": round(percentile(end_to_end_latency, 0.99) * 1000, 2),
+        },
+        "copy_code_outcomes": {
+            dict(key)["outcome"]: value for key, value in bot.metrics.sample("bot_copy_code_total").items()
+        },
+        "disk_bytes_written": bytes_written,
+        "group_messages_delivered": sum(len(d) for d in api.group_deliveries.values()),
+        "scheduler_drift_ms": {
+            "p50": round(percentile(drift, 0.50) * 1000, 2),
+            "p99": round(percentile(drift, 0.99) * 1000, 2),
+            "max": round(max(drift, default=0.0) * 1000, 2),
+        },
+        "scheduler_lateness_mean_ms": round(lateness[1] / lateness[2] * 1000, 3) if lateness[2] else 0.0,
+        "http_pool": {
+            name: {"requests": stats.requests, "connections": stats.connections,
+                   "reuse_ratio": round(stats.reuse_ratio, 4)}
+            for name, stats in bot.http_pool_stats.items()
+        },
+        "api_calls": api.calls,
+        "api_rate_limited": api.rate_limited,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس أداء البوت أمام خادم Bot API وهمي")
+    parser.add_argument("--groups", type=int, default=1000, help="عدد المجموعات")
+    parser.add_argument("--users", type=int, default=5000, help="عدد المستخدمين المختلفين")
+    parser.add_argument("--clicks-per-minute", type=float, default=10000, help="معدل نقرات Copy Code")
+    parser.add_argument("--duration", type=float, default=60, help="مدة الحقن بالثواني")
+    parser.add_argument("--drain", type=float, default=30, help="أقصى انتظار للنقرات المعلقة بعد الحقن")
+    parser.add_argument("--interval", type=int, default=600, help="فاصل الإرسال الدوري لكل مجموعة بالثواني")
+    parser.add_argument("--api-latency", type=float, default=0, help="زمن استجابة الخادم الوهمي بالمللي ثانية")
+    parser.add_argument("--error-rate", type=float, default=0, help="نسبة الطلبات التي تُرفض بخطأ 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="قيمة retry_after في أخطاء 429")
+    parser.add_argument("--global-rate", type=float, default=0,
+                        help="تجاوز الحد العام لطابور الإرسال (رسالة/ثانية)؛ 0 = حدود البوت الافتراضية")
+    parser.add_argument("--storage", choices=("json", "sqlite", "write-behind"), default=bot.STORAGE_BACKEND,
+                        help="واجهة تخزين المستخدمين")
+    parser.add_argument("--seed", type=int, default=1, help="بذرة العشوائية لنتائج قابلة للتكرار")
+    parser.add_argument("--json", action="store_true", help="طباعة النتيجة بصيغة JSON فقط")
+    args = parser.parse_args()
+
+    bot.STORAGE_BACKEND = "sqlite" if args.storage == "sqlite" else "json"
+    bot.USERS_WRITE_BEHIND = args.storage == "write-behind"
+    # سجلات كل رسالة تشوّه القياس، لذا تُعرض التحذيرات والأخطاء فقط
+    logging.disable(logging.INFO)
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    print(f"المجلد المؤقت للبيانات: {DATA_DIR}")
+    for key, value in result.items():
+        if key != "config":
+            print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,18 +7,38 @@ ChatGPTPlus2FABot - بوت تليجرام للمصادقة الثنائية 2FA
 """
 
 import os
+import signal
+import hashlib
+import re
+import copy
+import contextlib
+import sys
 import json
 import time
+import sqlite3
 import logging
 import threading
 import pyotp
+import math
 import datetime
 import asyncio
+import bisect
+import functools
+import concurrent.futures
+import collections
+import heapq
+import itertools
+import random
+import struct
+import httpx
 from dateutil import tz
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler, 
-    MessageHandler, ContextTypes, filters, ConversationHandler
+    MessageHandler, ContextTypes, filters, ConversationHandler,
+    BaseUpdateProcessor
 )
 
 # تكوين السجلات
@@ -38,17 +58,100 @@ ADMIN_ID = 764559466  # تحويل النص إلى رقم
     ADD_SECRET, EDIT_SECRET, MANAGE_INTERVAL,
     MANAGE_MESSAGE_STYLE, MANAGE_USER_ATTEMPTS, SELECT_GROUP_FOR_USER,
     SELECT_USER, MANAGE_USER, ADD_ATTEMPTS, REMOVE_ATTEMPTS,
-    MANAGE_ADMINS, ADD_ADMIN, REMOVE_ADMIN
-) = range(18)  # تم تصحيح عدد الحالات ليكون 18 بدلاً من 19
+    MANAGE_ADMINS, ADD_ADMIN, REMOVE_ADMIN, SEARCH_USER
+) = range(19)
 
-# ملفات البيانات
-DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+# ملفات البيانات (BOT_DATA_DIR يسمح بتشغيل نسخة بملفات منفصلة، مثل أدوات القياس)
+DATA_DIR = os.environ.get("BOT_DATA_DIR") or os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
 USERS_FILE = os.path.join(DATA_DIR, "users.json")
+DB_FILE = os.path.join(DATA_DIR, "bot.db")
+
+# واجهة التخزين الخلفية للمستخدمين: "json" (الافتراضي) أو "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json")
+
+# الكتابة المؤجلة لملف users.json (مع واجهة json فقط)
+JOURNAL_FILE = os.path.join(DATA_DIR, "users.journal")
+USERS_WRITE_BEHIND = os.environ.get("USERS_WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "5"))  # ثوانٍ بين الدفعات
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", "500"))  # تعديلات قبل الكتابة الفورية
+
+# حالة المجدول المحفوظة (آخر إرسال والموعد التالي لكل مجموعة) لاستئناف الطور بعد إعادة التشغيل
+SCHEDULE_FILE = os.path.join(DATA_DIR, "schedule.json")
+SCHEDULE_SAVE_INTERVAL = float(os.environ.get("SCHEDULE_SAVE_INTERVAL", "5"))  # ثوانٍ بين الحفظ
+# سياسة المواعيد الفائتة أثناء التوقف: "once" (إرسال واحد تعويضي) أو "skip" (انتظار الموعد التالي)
+SCHEDULE_CATCHUP = os.environ.get("SCHEDULE_CATCHUP", "once")
+# نافذة التوزيع العشوائي للإرسال التعويضي حتى لا ترسل كل المجموعات في نفس اللحظة
+SCHEDULE_CATCHUP_JITTER = float(os.environ.get("SCHEDULE_CATCHUP_JITTER", "60"))
+
+# قاطع الدائرة للمجموعات: عدد الأخطاء الدائمة المتتالية قبل الإيقاف المؤقت ومدة الانتظار قبل المحاولة التالية
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "3"))
+BREAKER_BASE_BACKOFF = float(os.environ.get("BREAKER_BASE_BACKOFF", "600"))  # ثوانٍ، تتضاعف مع كل فشل
+BREAKER_MAX_BACKOFF = float(os.environ.get("BREAKER_MAX_BACKOFF", "86400"))
+
+# مدة تذكر المستخدمين الذين لا يمكن مراسلتهم خاصة (لم يبدأوا محادثة أو حظروا البوت) بالثواني
+DM_UNREACHABLE_TTL = float(os.environ.get("DM_UNREACHABLE_TTL", "3600"))
+DM_UNREACHABLE_MAX = int(os.environ.get("DM_UNREACHABLE_MAX", "100000"))
+
+# حد نقرات Copy Code لكل (مستخدم، مجموعة): نقرات متتالية مسموحة ثم معدل مستمر بالنقرة/ثانية
+CLICK_THROTTLE_BURST = float(os.environ.get("CLICK_THROTTLE_BURST", "3"))
+CLICK_THROTTLE_RATE = float(os.environ.get("CLICK_THROTTLE_RATE", "0.2"))
+CLICK_THROTTLE_MAX = int(os.environ.get("CLICK_THROTTLE_MAX", "100000"))
+
+# نافذة تجاهل نقرات Copy Code المكررة بالثواني (0 = تعطيل)
+CALLBACK_DEDUPE_WINDOW = float(os.environ.get("CALLBACK_DEDUPE_WINDOW", "30"))
+
+# أقصى عدد من عدادات الحصص (النافذة المنزلقة / خطوة TOTP) في الذاكرة
+QUOTA_COUNTERS_MAX = int(os.environ.get("QUOTA_COUNTERS_MAX", "200000"))
+
+# فترة فحص config.json للتغييرات الخارجية بالثواني (0 = تعطيل إعادة التحميل التلقائي)
+CONFIG_RELOAD_INTERVAL = float(os.environ.get("CONFIG_RELOAD_INTERVAL", "2"))
+
+# عدد العناصر في كل صفحة من قوائم لوحة الإدارة
+ADMIN_PAGE_SIZE = 10
+
+# طريقة استقبال التحديثات: "polling" (الافتراضي) أو "webhook"
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+# المسار السري لاستقبال التحديثات (الافتراضي مشتق من التوكن حتى لا يمكن تخمينه)
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH") or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+# العنوان العام (مثل https://bot.example.com)؛ إذا تُرك فارغاً لا يتم استدعاء setWebhook
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+# عنوان خادم Bot API (فارغ = خوادم تيليجرام الرسمية)، مثال: http://127.0.0.1:8081/bot
+TELEGRAM_BASE_URL = os.environ.get("TELEGRAM_BASE_URL", "")
+
+# مجمع اتصالات HTTP المشترك مع Bot API
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "64"))  # أقصى عدد اتصالات متزامنة
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "30"))  # ثوانٍ قبل إغلاق اتصال خامل
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "5"))
+HTTP_WRITE_TIMEOUT = float(os.environ.get("HTTP_WRITE_TIMEOUT", "5"))
+HTTP_POOL_TIMEOUT = float(os.environ.get("HTTP_POOL_TIMEOUT", "3"))  # انتظار اتصال متاح من المجمع
+HTTP_VERSION = os.environ.get("HTTP_VERSION", "1.1")  # "1.1" أو "2" (يتطلب python-telegram-bot[http2])
+
+# المعالجة المتزامنة للتحديثات: عدد العمال والحد الأقصى للتحديثات المعلقة
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "32"))
+UPDATE_MAX_PENDING = int(os.environ.get("UPDATE_MAX_PENDING", "4096"))
+
+# نقطة مقاييس الأداء بصيغة Prometheus (المنفذ 0 = معطلة)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+# عدد أجزاء أقفال المستخدمين (يحدد أقصى عدد من المستخدمين المعالَجين بالتوازي دون تعارض)
+USER_LOCK_SHARDS = 1024
+
+# عدد المحاولات اليومية الافتراضية لكل مستخدم في كل مجموعة
+DEFAULT_ATTEMPTS = 5
+
+# مدة خطوة TOTP بالثواني
+TOTP_STEP = 30
 
 # هيكل البيانات الافتراضي
 DEFAULT_CONFIG = {
-    "groups": {},  # {"group_id": {"totp_secret": "SECRET", "interval": 600, "message_style": 1}}
+    "groups": {},  # {"group_id": {"totp_secret": "SECRET", "interval": 600, "message_style": 1, "align_to_totp": False, "send_offset": 0, "quota": {...}}}
     "admins": [ADMIN_ID]
 }
 
@@ -56,59 +159,1111 @@ DEFAULT_USERS = {
     # "user_id": {"attempts": {"group_id": {"remaining": 5, "reset_date": "YYYY-MM-DD"}}, "banned": False}
 }
 
-# متغيرات عالمية للتحكم بالمهام الدورية
-scheduled_tasks = {}
-stop_flags = {}
+# مصدر الوقت
+class SystemClock:
+    """الساعة الحقيقية؛ تمر عبرها جميع قراءات الوقت في الجدولة والرموز وإعادة التعيين اليومية"""
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def now(self, tzinfo=None):
+        return datetime.datetime.now(tzinfo)
+
+    def today(self, tzinfo=None):
+        """تاريخ اليوم بصيغة reset_date (بالتوقيت المحلي أو بالمنطقة الزمنية المحددة)"""
+        return self.now(tzinfo).strftime("%Y-%m-%d")
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+
+    async def wait(self, event, timeout=None):
+        """انتظار الحدث أو انتهاء المهلة؛ يرجع True إذا تم ضبط الحدث"""
+        if event.is_set():
+            return True
+        # asyncio.wait بدلاً من wait_for: في Python 3.11 قد يضيع الإلغاء إذا ضُبط الحدث في نفس اللحظة
+        waiter = asyncio.ensure_future(event.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=timeout)
+        finally:
+            waiter.cancel()
+        return waiter.done() and not waiter.cancelled()
+
+
+class VirtualClock(SystemClock):
+    """ساعة افتراضية للمحاكاة: لا يتقدم الوقت إلا باستدعاء advance_to()
+
+    المنتظرون عبر sleep()/wait() يُوقظون عند بلوغ مواعيدهم، بحيث يمكن تشغيل أيام
+    من الجدولة في ثوانٍ. الساعتان الحائطية والرتيبة متطابقتان.
+    """
+
+    def __init__(self, start=None):
+        self._now = time.time() if start is None else start
+        self._sleepers = []  # (الموعد، رقم تسلسلي، future)
+        self._seq = itertools.count()
+
+    def time(self):
+        return self._now
+
+    def monotonic(self):
+        return self._now
+
+    def now(self, tzinfo=None):
+        return datetime.datetime.fromtimestamp(self._now, tzinfo)
+
+    def _timer(self, delay):
+        # يُسجل الموعد فوراً (وليس عند بدء مهمة) حتى يراه next_deadline مباشرة
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self._now + max(0, delay), next(self._seq), future))
+        return future
+
+    async def sleep(self, delay):
+        await self._timer(delay)
+
+    async def wait(self, event, timeout=None):
+        if timeout is None:
+            await event.wait()
+            return True
+        waiter = asyncio.ensure_future(event.wait())
+        sleeper = self._timer(timeout)
+        try:
+            await asyncio.wait((waiter, sleeper), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            sleeper.cancel()
+        return event.is_set()
+
+    def next_deadline(self):
+        """أقرب موعد انتظار معلّق أو None"""
+        while self._sleepers and self._sleepers[0][2].done():
+            heapq.heappop(self._sleepers)
+        return self._sleepers[0][0] if self._sleepers else None
+
+    def advance_to(self, when):
+        """تقديم الوقت إلى when وإيقاظ كل من حان موعده"""
+        self._now = max(self._now, when)
+        while self._sleepers and self._sleepers[0][0] <= self._now:
+            _, _, future = heapq.heappop(self._sleepers)
+            if not future.done():
+                future.set_result(None)
+
+
+clock = SystemClock()
+
+# ذاكرة مؤقتة للإعدادات على مستوى العملية
+# يتم تقديم القراءات من الذاكرة ولا يُعاد قراءة الملف إلا عند تغيّر mtime أو الحجم
+_config_cache = {"data": None, "mtime": None, "size": None, "version": 0}
+_config_lock = threading.Lock()
+
+def _file_signature(path):
+    """إرجاع توقيع الملف (mtime بالنانو ثانية، الحجم) أو None إذا لم يكن موجوداً"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _update_config_cache(config, signature):
+    """تحديث الذاكرة المؤقتة للإعدادات وزيادة رقم الإصدار"""
+    _config_cache["data"] = config
+    _config_cache["mtime"], _config_cache["size"] = signature if signature else (None, None)
+    _config_cache["version"] += 1
+
+def get_config_version():
+    """رقم إصدار الإعدادات الحالي (يزداد مع كل تغيير)"""
+    return _config_cache["version"]
+
+# مقاييس الأداء
+class MetricsRegistry:
+    """عدادات ومدرجات تكرارية (histograms) بسيطة تُعرض بصيغة نص Prometheus
+
+    آمنة للاستدعاء من خيوط منفّذ الإدخال/الإخراج، ولا تحتاج أي مكتبة خارجية.
+    """
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (النوع، الوصف، الحدود)
+        self._values = {}  # name -> {labels: قيمة أو [عدادات الحدود، المجموع، العدد]}
+        self._callbacks = {}  # name -> دالة تُستدعى لحظة العرض
+
+    def counter(self, name, help_text):
+        self._meta[name] = ("counter", help_text, None)
+        self._values[name] = {}
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self._meta[name] = ("histogram", help_text, tuple(buckets))
+        self._values[name] = {}
+
+    def gauge(self, name, help_text, callback):
+        """مقياس تُقرأ قيمته عند العرض من callback (ترجع قائمة [(labels، القيمة)])"""
+        self._meta[name] = ("gauge", help_text, None)
+        self._callbacks[name] = callback
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items())) if labels else ()
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(labels)
+        buckets = self._meta[name][2]
+        with self._lock:
+            series = self._values[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = [[0] * len(buckets), 0.0, 0]
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def sample(self, name):
+        """نسخة من قيم المقياس {labels: القيمة} أو {labels: (عدادات الحدود، المجموع، العدد)}"""
+        with self._lock:
+            return {
+                key: (list(v[0]), v[1], v[2]) if isinstance(v, list) else v
+                for key, v in self._values[name].items()
+            }
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """قياس مدة الكتلة وتسجيلها في المدرج التكراري name"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _format_labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = []
+        for k, v in pairs:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped.append(f'{k}="{v}"')
+        return "{" + ",".join(escaped) + "}"
+
+    @staticmethod
+    def _format_value(value):
+        if value == math.inf:
+            return "+Inf"
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def render(self):
+        """إرجاع جميع المقاييس بصيغة عرض النص (text exposition format 0.0.4)"""
+        lines = []
+        with self._lock:
+            snapshot = {
+                name: {key: (copy.deepcopy(v) if isinstance(v, list) else v) for key, v in series.items()}
+                for name, series in self._values.items()
+            }
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                try:
+                    series = self._callbacks[name]()
+                except Exception as e:
+                    logger.warning(f"تعذر قراءة المقياس {name}: {e}")
+                    continue
+                for labels, value in series:
+                    lines.append(f"{name}{self._format_labels(self._key(labels))} {self._format_value(value)}")
+            elif kind == "counter":
+                for key, value in snapshot[name].items():
+                    lines.append(f"{name}{self._format_labels(key)} {self._format_value(value)}")
+            else:
+                for key, (counts, total, count) in snapshot[name].items():
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, counts):
+                        cumulative += bucket_count
+                        le = self._format_labels(key, [("le", self._format_value(float(bound)))])
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    lines.append(f"{name}_bucket{self._format_labels(key, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {self._format_value(total)}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.counter("bot_auth_messages_total", "Periodic 2FA messages by group and result")
+metrics.histogram("bot_send_auth_message_seconds", "Duration of send_auth_message by group")
+metrics.counter("bot_copy_code_total", "Copy Code clicks by outcome")
+metrics.histogram("bot_copy_code_seconds", "Duration of handle_copy_code by outcome")
+metrics.histogram("bot_storage_seconds", "Duration of storage load/save operations")
+metrics.counter("bot_storage_bytes_total", "Bytes read or written by storage operations")
+metrics.histogram("bot_scheduler_lateness_seconds", "Delay between a scheduled send and the moment it fired",
+                  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30, 60))
+metrics.histogram("bot_api_call_seconds", "Latency of Bot API HTTP calls by method (until response headers)")
+metrics.counter("bot_api_errors_total", "Failed outbound Bot API calls by method and error")
+metrics.histogram("bot_startup_seconds", "Duration of each bulk startup phase")
+metrics.gauge("bot_dm_unreachable_users", "Users cached as unable to receive private messages",
+              lambda: [({}, len(dm_unreachable))])
+metrics.gauge("bot_click_throttle_keys", "(user, group) pairs tracked by the Copy Code throttle",
+              lambda: [({}, len(click_throttle))])
+metrics.gauge("bot_callback_dedupe_keys", "Copy Code callbacks remembered for duplicate detection",
+              lambda: [({}, len(copy_code_deduper))])
+metrics.gauge("bot_quota_counters", "Sliding-window quota counters held in memory",
+              lambda: [({}, len(copy_code_quotas))])
+metrics.gauge("bot_groups_circuit_open", "Groups whose periodic messages are paused by the circuit breaker",
+              lambda: [({}, len(group_breakers.open_groups()))])
+metrics.counter("bot_http_requests_total", "HTTP requests sent to the Bot API by connection pool")
+metrics.counter("bot_http_connections_opened_total", "New TCP connections opened by connection pool")
+metrics.gauge("bot_http_connection_reuse_ratio", "Share of requests served over an existing connection",
+              lambda: [({"pool": name}, stats.reuse_ratio) for name, stats in http_pool_stats.items()])
+metrics.gauge("bot_outbound_queue_depth", "Requests waiting in the outbound send queue by lane",
+              lambda: [({"lane": lane}, outbox.qsize(lane)) for lane in (OutboundQueue.LANE_DM, OutboundQueue.LANE_BROADCAST)])
+metrics.gauge("bot_scheduled_groups", "Groups currently scheduled for periodic messages",
+              lambda: [({}, len(scheduler))])
 
 # وظائف إدارة البيانات
-def load_config():
-    """تحميل ملف الإعدادات"""
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    else:
-        # إنشاء ملف الإعدادات إذا لم يكن موجوداً
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(DEFAULT_CONFIG, f, ensure_ascii=False, indent=4)
-        return DEFAULT_CONFIG
+def load_config(readonly=False):
+    """تحميل ملف الإعدادات (من الذاكرة المؤقتة ما لم يتغير الملف على القرص)
+
+    يرجع نسخة مستقلة يمكن تعديلها ثم حفظها بـ save_config. مع readonly=True تُرجع نسخة
+    الذاكرة المؤقتة المشتركة نفسها دون نسخ (للقراءة فقط في المسارات المتكررة).
+    """
+    config = _load_config_cached()
+    return config if readonly else copy.deepcopy(config)
+
+def _load_config_cached():
+    with _config_lock:
+        signature = _file_signature(CONFIG_FILE)
+        cached = _config_cache["data"]
+        if (cached is not None and signature is not None
+                and signature == (_config_cache["mtime"], _config_cache["size"])):
+            return cached
+
+        if signature is not None:
+            with metrics.timer("bot_storage_seconds", op="load_config"):
+                with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            metrics.inc("bot_storage_bytes_total", signature[1], op="load_config")
+        else:
+            # إنشاء ملف الإعدادات إذا لم يكن موجوداً
+            config = copy.deepcopy(DEFAULT_CONFIG)
+            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+                json.dump(config, f, ensure_ascii=False, indent=4)
+            signature = _file_signature(CONFIG_FILE)
+
+        _update_config_cache(config, signature)
+        return config
 
 def save_config(config):
-    """حفظ ملف الإعدادات"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
+    """حفظ ملف الإعدادات (بشكل ذري) ثم تحديث الذاكرة المؤقتة بنسخة منه"""
+    with _config_lock:
+        tmp_path = CONFIG_FILE + ".tmp"
+        with metrics.timer("bot_storage_seconds", op="save_config"):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, CONFIG_FILE)
+        signature = _file_signature(CONFIG_FILE)
+        if signature is not None:
+            metrics.inc("bot_storage_bytes_total", signature[1], op="save_config")
+        # لا تُحدّث الذاكرة المؤقتة إلا بعد نجاح الكتابة، وبنسخة لا يشاركها المستدعي
+        _update_config_cache(copy.deepcopy(config), signature)
 
 def load_users():
     """تحميل بيانات المستخدمين"""
     if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with metrics.timer("bot_storage_seconds", op="load_users"):
+            with open(USERS_FILE, 'r', encoding='utf-8') as f:
+                users = json.load(f)
+                metrics.inc("bot_storage_bytes_total", f.tell(), op="load_users")
+        return users
     else:
         # إنشاء ملف المستخدمين إذا لم يكن موجوداً
         with open(USERS_FILE, 'w', encoding='utf-8') as f:
             json.dump(DEFAULT_USERS, f, ensure_ascii=False, indent=4)
-        return DEFAULT_USERS
+        return copy.deepcopy(DEFAULT_USERS)
 
 def save_users(users):
     """حفظ بيانات المستخدمين"""
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=4)
+    with metrics.timer("bot_storage_seconds", op="save_users"):
+        with open(USERS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(users, f, ensure_ascii=False, indent=4)
+            metrics.inc("bot_storage_bytes_total", f.tell(), op="save_users")
+
+def load_schedule_state():
+    """تحميل حالة المجدول المحفوظة {group_id: {"last_sent", "next_due", "interval"}}
+
+    يرجع None إذا لم يوجد الملف أو كان تالفاً (أول تشغيل بعد الترقية مثلاً).
+    """
+    if not os.path.exists(SCHEDULE_FILE):
+        return None
+    try:
+        with open(SCHEDULE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except ValueError as e:
+        logger.warning(f"تم تجاهل ملف حالة المجدول التالف {SCHEDULE_FILE}: {e}")
+        return None
+
+def save_schedule_state(state):
+    """حفظ حالة المجدول (كتابة ذرية عبر ملف مؤقت)"""
+    tmp_path = SCHEDULE_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, SCHEDULE_FILE)
+
+# طبقة تخزين المستخدمين والمحاولات
+# كل عملية (خصم/استرجاع محاولة، حظر، إضافة محاولات) تمثل معاملة واحدة في الواجهة الخلفية
+def paginate_sorted(keys, after=None, before=None, limit=None, prefix=None):
+    """صفحة من قائمة مرتبة بمؤشر (بعد المفتاح after أو قبل before) مع تصفية اختيارية ببادئة
+
+    يرجع (مفاتيح الصفحة، توجد صفحة سابقة، توجد صفحة تالية).
+    """
+    limit = limit or ADMIN_PAGE_SIZE
+    lo, hi = 0, len(keys)
+    if prefix:
+        lo = bisect.bisect_left(keys, prefix)
+        hi = bisect.bisect_left(keys, prefix + "\uffff", lo)
+    if before is not None:
+        end = bisect.bisect_left(keys, before, lo, hi)
+        start = max(lo, end - limit)
+    else:
+        start = bisect.bisect_right(keys, after, lo, hi) if after is not None else lo
+        end = min(hi, start + limit)
+    return keys[start:end], start > lo, end < hi
+
+
+class UserIndex:
+    """فهرس المجموعة -> المستخدمون مع قوائم مرتبة لتقسيم الصفحات"""
+
+    def __init__(self, users=None):
+        self._group_users = {}
+        self._sorted = {}  # group_id -> قائمة مرتبة (تُبنى عند الحاجة وتُبطل عند تغير العضوية)
+        if users:
+            self.rebuild(users)
+
+    def rebuild(self, users):
+        """إعادة بناء الفهرس من بيانات users.json كاملة"""
+        self._group_users.clear()
+        self._sorted.clear()
+        for user_id, user_data in users.items():
+            for group_id in user_data.get("attempts", {}):
+                self.add(user_id, group_id)
+
+    def add(self, user_id, group_id):
+        members = self._group_users.setdefault(group_id, set())
+        if user_id not in members:
+            members.add(user_id)
+            self._sorted.pop(group_id, None)
+
+    def remove(self, user_id, group_id):
+        self._group_users.get(group_id, set()).discard(user_id)
+        self._sorted.pop(group_id, None)
+
+    def sorted_group_users(self, group_id):
+        """مستخدمو المجموعة بترتيب ثابت (لتقسيم الصفحات)"""
+        keys = self._sorted.get(group_id)
+        if keys is None:
+            keys = self._sorted[group_id] = sorted(self._group_users.get(group_id, ()))
+        return keys
+
+    def count(self, group_id):
+        return len(self._group_users.get(group_id, ()))
+
+
+class JsonUserStore:
+    """تخزين المستخدمين في ملف users.json (يُعاد كتابة الملف كاملاً مع كل تعديل)
+
+    يُحتفظ بنسخة في الذاكرة مع فهرس المجموعات، ولا يُعاد تحليل الملف إلا إذا تغير على القرص.
+    """
+
+    def __init__(self):
+        self.path = USERS_FILE
+        self._lock = threading.Lock()
+        self._users = None
+        self._signature = None
+        self._index = UserIndex()
+
+    def _load(self):
+        signature = _file_signature(self.path)
+        if self._users is None or signature is None or signature != self._signature:
+            self._users = load_users()
+            self._signature = _file_signature(self.path)
+            self._index.rebuild(self._users)
+        return self._users
+
+    def _save(self, users):
+        save_users(users)
+        self._signature = _file_signature(self.path)
+
+    def get_user(self, user_id):
+        """إرجاع نسخة من بيانات المستخدم أو None"""
+        with self._lock:
+            user = self._load().get(user_id)
+            return copy.deepcopy(user) if user is not None else None
+
+    def count_group_users(self, group_id):
+        """عدد مستخدمي المجموعة"""
+        with self._lock:
+            self._load()
+            return self._index.count(group_id)
+
+    def list_group_users_page(self, group_id, after=None, before=None, limit=None, prefix=None):
+        """صفحة من مستخدمي المجموعة: ([(user_id, السجل)], توجد سابقة، توجد تالية)"""
+        with self._lock:
+            users = self._load()
+            keys, has_prev, has_next = paginate_sorted(
+                self._index.sorted_group_users(group_id), after, before, limit, prefix
+            )
+            return [(u, dict(users[u]["attempts"][group_id])) for u in keys], has_prev, has_next
+
+    def consume_attempt(self, user_id, group_id, today, default_attempts=DEFAULT_ATTEMPTS):
+        """خصم محاولة واحدة مع إعادة التعيين اليومية؛ يرجع (الحالة، المتبقي)"""
+        with self._lock:
+            users = self._load()
+            user = users.setdefault(user_id, {"attempts": {}, "banned": False})
+            if user.get("banned", False):
+                return "banned", 0
+            attempts = user.setdefault("attempts", {})
+            record = attempts.get(group_id)
+            if record is None or record["reset_date"] != today:
+                record = attempts[group_id] = {"remaining": default_attempts, "reset_date": today}
+                self._index.add(user_id, group_id)
+            if record["remaining"] <= 0:
+                return "exhausted", 0
+            record["remaining"] -= 1
+            self._save(users)
+            return "ok", record["remaining"]
+
+    def refund_attempt(self, user_id, group_id):
+        """استعادة محاولة تم خصمها"""
+        with self._lock:
+            users = self._load()
+            record = users.get(user_id, {}).get("attempts", {}).get(group_id)
+            if record is not None:
+                record["remaining"] += 1
+                self._save(users)
+
+    def add_attempts(self, user_id, group_id, count, today):
+        """إضافة محاولات للمستخدم؛ يرجع العدد المتبقي الجديد"""
+        with self._lock:
+            users = self._load()
+            user = users.setdefault(user_id, {"attempts": {}, "banned": False})
+            record = user.setdefault("attempts", {}).setdefault(
+                group_id, {"remaining": 0, "reset_date": today}
+            )
+            self._index.add(user_id, group_id)
+            record["remaining"] += count
+            self._save(users)
+            return record["remaining"]
+
+    def remove_attempts(self, user_id, group_id, count):
+        """حذف محاولات من المستخدم؛ يرجع عدد المحاولات المحذوفة أو None"""
+        with self._lock:
+            users = self._load()
+            record = users.get(user_id, {}).get("attempts", {}).get(group_id)
+            if record is None:
+                return None
+            removed_count = min(count, record["remaining"])
+            record["remaining"] = max(0, record["remaining"] - count)
+            self._save(users)
+            return removed_count
+
+    def toggle_ban(self, user_id):
+        """تبديل حالة الحظر؛ يرجع الحالة الجديدة أو None إذا لم يوجد المستخدم"""
+        with self._lock:
+            users = self._load()
+            if user_id not in users:
+                return None
+            users[user_id]["banned"] = not users[user_id].get("banned", False)
+            self._save(users)
+            return users[user_id]["banned"]
+
+    def close(self):
+        pass
+
+
+class WriteBehindUserStore:
+    """تخزين users.json بنمط الكتابة المؤجلة
+
+    تُطبق التعديلات في الذاكرة فوراً وتُضاف إلى سجل (journal) ملحق فقط،
+    ثم تُكتب الحالة الموحدة إلى users.json على دفعات (حسب الوقت أو عدد التعديلات).
+    عند بدء التشغيل بعد توقف مفاجئ يُعاد تطبيق السجل على آخر نسخة محفوظة.
+    كل سجل يحمل الحالة النهائية للحقل المعدل، لذا فإعادة تطبيقه آمنة أكثر من مرة.
+    """
+
+    def __init__(self, users_file=USERS_FILE, journal_file=JOURNAL_FILE,
+                 flush_interval=WRITE_BEHIND_INTERVAL, flush_every=WRITE_BEHIND_MAX_PENDING):
+        self.path = users_file
+        self.journal_path = journal_file
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._users = self._read_users(users_file)
+        self._index = UserIndex(self._users)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+        replayed = self._replay_journal()
+        self._journal = open(journal_file, 'a', encoding='utf-8')
+        if replayed:
+            logger.info(f"تمت استعادة {replayed} تعديل من سجل المستخدمين {journal_file}")
+        if self._journal.tell() > 0:
+            # دمج السجل المستعاد (وإزالة أي سطر تالف) قبل إلحاق تعديلات جديدة
+            self.flush()
+
+    @staticmethod
+    def _read_users(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _apply(self, record):
+        user = self._users.setdefault(record["u"], {"attempts": {}, "banned": False})
+        if "b" in record:
+            user["banned"] = record["b"]
+        if "g" in record:
+            user.setdefault("attempts", {})[record["g"]] = {"remaining": record["r"], "reset_date": record["d"]}
+            self._index.add(record["u"], record["g"])
+
+    def _replay_journal(self):
+        if not os.path.exists(self.journal_path):
+            return 0
+        count = 0
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # سطر أخير غير مكتمل بسبب التوقف أثناء الكتابة
+                    logger.warning(f"تم تجاهل سطر تالف في سجل المستخدمين {self.journal_path}")
+                    continue
+                self._apply(record)
+                count += 1
+        return count
+
+    def _record(self, record):
+        """تطبيق التعديل في الذاكرة وإلحاقه بالسجل (يُستدعى مع الاحتفاظ بالقفل)"""
+        self._apply(record)
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        self._journal.write(line)
+        self._journal.flush()
+        metrics.inc("bot_storage_bytes_total", len(line.encode("utf-8")), op="journal_users")
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self._flush_locked()
+
+    def _attempts_record(self, user_id, group_id):
+        record = self._users[user_id]["attempts"][group_id]
+        return {"u": user_id, "g": group_id, "r": record["remaining"], "d": record["reset_date"]}
+
+    def _flush_locked(self):
+        tmp_path = self.path + ".tmp"
+        with metrics.timer("bot_storage_seconds", op="flush_users"):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._users, f, ensure_ascii=False, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+                metrics.inc("bot_storage_bytes_total", f.tell(), op="flush_users")
+            os.replace(tmp_path, self.path)
+        # لا يُفرغ السجل إلا بعد استبدال الملف بنجاح
+        self._journal.truncate(0)
+        self._journal.seek(0)
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        """كتابة الحالة الموحدة إلى users.json وتفريغ السجل"""
+        with self._lock:
+            self._flush_locked()
+
+    def flush_if_due(self):
+        """الكتابة إذا وُجدت تعديلات معلقة ومضت فترة الكتابة المؤجلة"""
+        with self._lock:
+            if self._pending and time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_locked()
+
+    def get_user(self, user_id):
+        """إرجاع نسخة من بيانات المستخدم أو None"""
+        with self._lock:
+            user = self._users.get(user_id)
+            return copy.deepcopy(user) if user is not None else None
+
+    def count_group_users(self, group_id):
+        """عدد مستخدمي المجموعة"""
+        with self._lock:
+            return self._index.count(group_id)
+
+    def list_group_users_page(self, group_id, after=None, before=None, limit=None, prefix=None):
+        """صفحة من مستخدمي المجموعة: ([(user_id, السجل)], توجد سابقة، توجد تالية)"""
+        with self._lock:
+            keys, has_prev, has_next = paginate_sorted(
+                self._index.sorted_group_users(group_id), after, before, limit, prefix
+            )
+            return [(u, dict(self._users[u]["attempts"][group_id])) for u in keys], has_prev, has_next
+
+    def consume_attempt(self, user_id, group_id, today, default_attempts=DEFAULT_ATTEMPTS):
+        """خصم محاولة واحدة مع إعادة التعيين اليومية؛ يرجع (الحالة، المتبقي)"""
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is not None and user.get("banned", False):
+                return "banned", 0
+            record = user.get("attempts", {}).get(group_id) if user else None
+            if record is None or record["reset_date"] != today:
+                remaining = default_attempts
+            else:
+                remaining = record["remaining"]
+            if remaining <= 0:
+                return "exhausted", 0
+            self._record({"u": user_id, "g": group_id, "r": remaining - 1, "d": today})
+            return "ok", remaining - 1
+
+    def refund_attempt(self, user_id, group_id):
+        """استعادة محاولة تم خصمها"""
+        with self._lock:
+            record = self._users.get(user_id, {}).get("attempts", {}).get(group_id)
+            if record is not None:
+                self._record({"u": user_id, "g": group_id, "r": record["remaining"] + 1, "d": record["reset_date"]})
+
+    def add_attempts(self, user_id, group_id, count, today):
+        """إضافة محاولات للمستخدم؛ يرجع العدد المتبقي الجديد"""
+        with self._lock:
+            record = self._users.get(user_id, {}).get("attempts", {}).get(group_id)
+            remaining = (record["remaining"] if record else 0) + count
+            reset_date = record["reset_date"] if record else today
+            self._record({"u": user_id, "g": group_id, "r": remaining, "d": reset_date})
+            return remaining
+
+    def remove_attempts(self, user_id, group_id, count):
+        """حذف محاولات من المستخدم؛ يرجع عدد المحاولات المحذوفة أو None"""
+        with self._lock:
+            record = self._users.get(user_id, {}).get("attempts", {}).get(group_id)
+            if record is None:
+                return None
+            removed_count = min(count, record["remaining"])
+            self._record({"u": user_id, "g": group_id, "r": max(0, record["remaining"] - count), "d": record["reset_date"]})
+            return removed_count
+
+    def toggle_ban(self, user_id):
+        """تبديل حالة الحظر؛ يرجع الحالة الجديدة أو None إذا لم يوجد المستخدم"""
+        with self._lock:
+            if user_id not in self._users:
+                return None
+            banned = not self._users[user_id].get("banned", False)
+            self._record({"u": user_id, "b": banned})
+            return banned
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._journal.close()
 
-def is_admin(user_id):
+
+class SqliteUserStore:
+    """تخزين المستخدمين في SQLite بوضع WAL (كل تعديل هو تحديث صف واحد مفهرس)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            banned INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS attempts (
+            user_id TEXT NOT NULL,
+            group_id TEXT NOT NULL,
+            remaining INTEGER NOT NULL,
+            reset_date TEXT NOT NULL,
+            PRIMARY KEY (user_id, group_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_attempts_group ON attempts (group_id, user_id);
+    """
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
+        self._wal_last = self._wal_frames() or 0
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """معاملة كتابة فورية (BEGIN IMMEDIATE) تُلغى عند حدوث استثناء"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        else:
+            self._conn.execute("COMMIT")
+            self._meter_writes()
+
+    def _wal_frames(self):
+        """عدد إطارات WAL الصالحة من ترويسة wal-index في ملف -shm (None إذا لم يوجد)"""
+        try:
+            with open(self.path + "-shm", "rb") as f:
+                header = f.read(20)
+        except OSError:
+            return None
+        if len(header) < 20:
+            return None
+        # WalIndexHdr.mxFrame عند الإزاحة 16 بترتيب بايتات الجهاز
+        return struct.unpack_from("=I", header, 16)[0]
+
+    def _meter_writes(self):
+        """تسجيل البايتات المكتوبة في WAL منذ آخر معاملة في المقاييس
+
+        لا تُحسب نقاط التفتيش: تنسخ كل صفحة معدلة مرة واحدة فقط مهما تكررت إطاراتها.
+        """
+        frames = self._wal_frames()
+        if frames is None:
+            return
+        # بعد نقطة تفتيش يُعاد استخدام WAL من بدايته فيعود العداد إلى الصفر
+        written = frames - self._wal_last if frames >= self._wal_last else frames
+        self._wal_last = frames
+        if written:
+            metrics.inc("bot_storage_bytes_total", written * (self._page_size + 24), op="sqlite_wal")
+
+    def get_user(self, user_id):
+        """إرجاع بيانات المستخدم بنفس شكل users.json أو None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT banned FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            rows = self._conn.execute(
+                "SELECT group_id, remaining, reset_date FROM attempts WHERE user_id = ?", (user_id,)
+            ).fetchall()
+        return {
+            "attempts": {g: {"remaining": r, "reset_date": d} for g, r, d in rows},
+            "banned": bool(row[0]),
+        }
+
+    def count_group_users(self, group_id):
+        """عدد مستخدمي المجموعة (من فهرس idx_attempts_group)"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM attempts WHERE group_id = ?", (group_id,)
+            ).fetchone()[0]
+
+    def list_group_users_page(self, group_id, after=None, before=None, limit=None, prefix=None):
+        """صفحة من مستخدمي المجموعة: ([(user_id, السجل)], توجد سابقة، توجد تالية)"""
+        limit = limit or ADMIN_PAGE_SIZE
+        bounds = "group_id = ?"
+        params = [group_id]
+        if prefix:
+            bounds += " AND user_id >= ? AND user_id < ?"
+            params += [prefix, prefix + "\uffff"]
+        with self._lock:
+            if before is not None:
+                rows = self._conn.execute(
+                    f"SELECT user_id, remaining, reset_date FROM attempts WHERE {bounds} AND user_id < ? "
+                    "ORDER BY user_id DESC LIMIT ?", params + [before, limit + 1]
+                ).fetchall()
+                has_prev = len(rows) > limit
+                rows = rows[:limit][::-1]
+                has_next = True
+            else:
+                cursor_clause = " AND user_id > ?" if after is not None else ""
+                cursor_params = [after] if after is not None else []
+                rows = self._conn.execute(
+                    f"SELECT user_id, remaining, reset_date FROM attempts WHERE {bounds}{cursor_clause} "
+                    "ORDER BY user_id LIMIT ?", params + cursor_params + [limit + 1]
+                ).fetchall()
+                has_next = len(rows) > limit
+                rows = rows[:limit]
+                has_prev = after is not None and bool(rows) and self._conn.execute(
+                    f"SELECT 1 FROM attempts WHERE {bounds} AND user_id < ? LIMIT 1", params + [rows[0][0]]
+                ).fetchone() is not None
+        return [(u, {"remaining": r, "reset_date": d}) for u, r, d in rows], has_prev, has_next
+
+    def consume_attempt(self, user_id, group_id, today, default_attempts=DEFAULT_ATTEMPTS):
+        """خصم محاولة واحدة مع إعادة التعيين اليومية؛ يرجع (الحالة، المتبقي)"""
+        with self._lock, self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO users (user_id, banned) VALUES (?, 0)", (user_id,))
+            if conn.execute("SELECT banned FROM users WHERE user_id = ?", (user_id,)).fetchone()[0]:
+                return "banned", 0
+            row = conn.execute(
+                "SELECT remaining, reset_date FROM attempts WHERE user_id = ? AND group_id = ?",
+                (user_id, group_id)
+            ).fetchone()
+            if row is None or row[1] != today:
+                remaining = default_attempts
+                conn.execute(
+                    "INSERT OR REPLACE INTO attempts (user_id, group_id, remaining, reset_date) VALUES (?, ?, ?, ?)",
+                    (user_id, group_id, remaining, today)
+                )
+            else:
+                remaining = row[0]
+            if remaining <= 0:
+                return "exhausted", 0
+            conn.execute(
+                "UPDATE attempts SET remaining = remaining - 1 WHERE user_id = ? AND group_id = ?",
+                (user_id, group_id)
+            )
+            return "ok", remaining - 1
+
+    def refund_attempt(self, user_id, group_id):
+        """استعادة محاولة تم خصمها"""
+        with self._lock, self._transaction() as conn:
+            conn.execute(
+                "UPDATE attempts SET remaining = remaining + 1 WHERE user_id = ? AND group_id = ?",
+                (user_id, group_id)
+            )
+
+    def add_attempts(self, user_id, group_id, count, today):
+        """إضافة محاولات للمستخدم؛ يرجع العدد المتبقي الجديد"""
+        with self._lock, self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO users (user_id, banned) VALUES (?, 0)", (user_id,))
+            conn.execute(
+                "INSERT INTO attempts (user_id, group_id, remaining, reset_date) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (user_id, group_id) DO UPDATE SET remaining = remaining + excluded.remaining",
+                (user_id, group_id, count, today)
+            )
+            return conn.execute(
+                "SELECT remaining FROM attempts WHERE user_id = ? AND group_id = ?", (user_id, group_id)
+            ).fetchone()[0]
+
+    def remove_attempts(self, user_id, group_id, count):
+        """حذف محاولات من المستخدم؛ يرجع عدد المحاولات المحذوفة أو None"""
+        with self._lock, self._transaction() as conn:
+            row = conn.execute(
+                "SELECT remaining FROM attempts WHERE user_id = ? AND group_id = ?", (user_id, group_id)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE attempts SET remaining = MAX(0, remaining - ?) WHERE user_id = ? AND group_id = ?",
+                (count, user_id, group_id)
+            )
+            return min(count, row[0])
+
+    def toggle_ban(self, user_id):
+        """تبديل حالة الحظر؛ يرجع الحالة الجديدة أو None إذا لم يوجد المستخدم"""
+        with self._lock, self._transaction() as conn:
+            conn.execute("UPDATE users SET banned = 1 - banned WHERE user_id = ?", (user_id,))
+            row = conn.execute("SELECT banned FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            return None if row is None else bool(row[0])
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+
+def get_store():
+    """إرجاع واجهة التخزين المحددة في STORAGE_BACKEND"""
+    global _store
+    if _store is None:
+        if STORAGE_BACKEND == "sqlite":
+            _store = SqliteUserStore(DB_FILE)
+        elif USERS_WRITE_BEHIND:
+            _store = WriteBehindUserStore()
+        else:
+            _store = JsonUserStore()
+    return _store
+
+# أقفال المستخدمين
+class ShardedLocks:
+    """أقفال غير متزامنة موزعة على عدد ثابت من الأجزاء حسب المفتاح
+
+    يتشارك المستخدمون في نفس الجزء قفلاً واحداً، فتبقى الذاكرة ثابتة
+    ولا يُسلسل جميع المستخدمين خلف قفل عام واحد.
+    """
+
+    def __init__(self, shards=USER_LOCK_SHARDS):
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+
+    def __call__(self, key):
+        return self._locks[hash(key) % len(self._locks)]
+
+
+user_locks = ShardedLocks()
+
+# طبقة الإدخال/الإخراج غير المتزامنة
+class AsyncPersistence:
+    """تنفيذ عمليات القرص في منفّذ مخصص خارج حلقة الأحداث مع تسلسل الكتابة لكل ملف"""
+
+    def __init__(self, max_workers=2):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="persistence"
+        )
+        self._write_locks = {}
+
+    async def run(self, func, *args):
+        """تنفيذ عملية قراءة في المنفّذ"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    async def run_write(self, path, func, *args):
+        """تنفيذ عملية كتابة في المنفّذ مع منع الكتابات المتزامنة على نفس الملف"""
+        lock = self._write_locks.get(path)
+        if lock is None:
+            lock = self._write_locks[path] = asyncio.Lock()
+        async with lock:
+            return await self.run(func, *args)
+
+    async def load_config(self, readonly=False):
+        return await self.run(load_config, readonly)
+
+    async def save_config(self, config):
+        await self.run_write(CONFIG_FILE, save_config, config)
+
+    async def load_schedule(self):
+        return await self.run(load_schedule_state)
+
+    async def save_schedule(self, state):
+        await self.run_write(SCHEDULE_FILE, save_schedule_state, state)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class AsyncUserStore:
+    """واجهة قابلة للانتظار فوق واجهة التخزين المتزامنة
+
+    عمليات المحاولات لا تمر بقفل الملف العام: كل استدعاء ذري بقفل واجهة التخزين نفسها،
+    وترتيب عمليات المستخدم الواحد يضمنه user_locks لدى المستدعي. قفل الملف للكتابة المجمعة فقط.
+    """
+
+    def __init__(self, store, persistence):
+        self._store = store
+        self._persistence = persistence
+        self._flusher = None
+
+    def start(self):
+        """بدء مهمة الكتابة الدورية إذا كانت واجهة التخزين تدعم الكتابة المؤجلة"""
+        if hasattr(self._store, "flush_if_due") and (self._flusher is None or self._flusher.done()):
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """إيقاف مهمة الكتابة الدورية وكتابة ما تبقى من تعديلات"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flusher
+            self._flusher = None
+        if hasattr(self._store, "flush"):
+            await self._persistence.run_write(self._store.path, self._store.flush)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self._store.flush_interval)
+            try:
+                await self._persistence.run_write(self._store.path, self._store.flush_if_due)
+            except Exception as e:
+                logger.error(f"خطأ في الكتابة المؤجلة لبيانات المستخدمين: {e}")
+
+    async def get_user(self, user_id):
+        return await self._persistence.run(self._store.get_user, user_id)
+
+    async def count_group_users(self, group_id):
+        return await self._persistence.run(self._store.count_group_users, group_id)
+
+    async def list_group_users_page(self, group_id, after=None, before=None, limit=None, prefix=None):
+        return await self._persistence.run(
+            self._store.list_group_users_page, group_id, after, before, limit, prefix
+        )
+
+    async def consume_attempt(self, user_id, group_id, today, default_attempts=DEFAULT_ATTEMPTS):
+        return await self._persistence.run(
+            self._store.consume_attempt, user_id, group_id, today, default_attempts
+        )
+
+    async def refund_attempt(self, user_id, group_id):
+        return await self._persistence.run(self._store.refund_attempt, user_id, group_id)
+
+    async def add_attempts(self, user_id, group_id, count, today):
+        return await self._persistence.run(self._store.add_attempts, user_id, group_id, count, today)
+
+    async def remove_attempts(self, user_id, group_id, count):
+        return await self._persistence.run(self._store.remove_attempts, user_id, group_id, count)
+
+    async def toggle_ban(self, user_id):
+        return await self._persistence.run(self._store.toggle_ban, user_id)
+
+
+persistence = AsyncPersistence()
+_async_store = None
+
+def get_async_store():
+    """إرجاع الواجهة غير المتزامنة لواجهة التخزين الحالية"""
+    global _async_store
+    if _async_store is None:
+        _async_store = AsyncUserStore(get_store(), persistence)
+    return _async_store
+
+def migrate_json_to_sqlite(users_file=USERS_FILE, config_file=CONFIG_FILE, db_file=DB_FILE):
+    """ترحيل لمرة واحدة من users.json إلى قاعدة SQLite"""
+    if not os.path.exists(users_file):
+        # تثبيت جديد: لا بيانات للترحيل
+        logger.info(f"الملف {users_file} غير موجود، لا توجد بيانات للترحيل")
+        return 0, 0
+    with open(users_file, 'r', encoding='utf-8') as f:
+        users = json.load(f)
+    known_groups = None
+    if os.path.exists(config_file):
+        with open(config_file, 'r', encoding='utf-8') as f:
+            known_groups = set(json.load(f).get("groups", {}))
+
+    user_rows = []
+    attempt_rows = []
+    skipped = collections.Counter()  # group_id -> عدد السجلات المتخطاة
+    for user_id, user_data in users.items():
+        user_rows.append((str(user_id), 1 if user_data.get("banned", False) else 0))
+        for group_id, record in user_data.get("attempts", {}).items():
+            if known_groups is not None and group_id not in known_groups:
+                # محاولات لمجموعة محذوفة من الإعدادات
+                skipped[group_id] += 1
+                continue
+            attempt_rows.append((str(user_id), group_id, int(record["remaining"]), record["reset_date"]))
+
+    store = SqliteUserStore(db_file)
+    try:
+        with store._lock, store._transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO users (user_id, banned) VALUES (?, ?)", user_rows)
+            conn.executemany(
+                "INSERT OR REPLACE INTO attempts (user_id, group_id, remaining, reset_date) VALUES (?, ?, ?, ?)",
+                attempt_rows
+            )
+    finally:
+        store.close()
+
+    logger.info(f"تم ترحيل {len(user_rows)} مستخدم و{len(attempt_rows)} سجل محاولات إلى {db_file}")
+    if skipped:
+        logger.warning(
+            f"تم تخطي {sum(skipped.values())} سجل محاولات لمجموعات غير موجودة في الإعدادات: "
+            + ", ".join(f"{group_id} ({count})" for group_id, count in sorted(skipped.items()))
+        )
+    return len(user_rows), len(attempt_rows)
+
+async def is_admin(user_id):
     """التحقق مما إذا كان المستخدم مسؤولاً"""
-    config = load_config()
+    config = await persistence.load_config(readonly=True)
     return user_id in config["admins"]
 
 def get_time_format(timezone_name="UTC"):
     """الحصول على الوقت الحالي بتنسيق 12 ساعة"""
     timezone = tz.gettz(timezone_name)
-    now = datetime.datetime.now(timezone)
+    now = clock.now(timezone)
     return now.strftime("%I:%M:%S %p")  # تنسيق 12 ساعة مع AM/PM
 
-def get_next_time(interval_seconds, timezone_name="UTC"):
-    """حساب وقت الرمز التالي"""
+def get_next_time(interval_seconds, timezone_name="UTC", next_send_at=None):
+    """حساب وقت الرمز التالي (أو تنسيق الموعد المجدول next_send_at إن وُجد)"""
     timezone = tz.gettz(timezone_name)
-    now = datetime.datetime.now(timezone)
-    next_time = now + datetime.timedelta(seconds=interval_seconds)
+    if next_send_at is not None:
+        next_time = datetime.datetime.fromtimestamp(next_send_at, timezone)
+    else:
+        now = clock.now(timezone)
+        next_time = now + datetime.timedelta(seconds=interval_seconds)
     return next_time.strftime("%I:%M:%S %p")  # تنسيق 12 ساعة مع AM/PM
 
 def format_interval(seconds):
@@ -124,12 +1279,70 @@ def format_interval(seconds):
 
 def get_remaining_validity(totp):
     """حساب الوقت المتبقي لصلاحية الرمز بالثواني"""
-    return 30 - int(time.time()) % 30
+    return TOTP_STEP - int(clock.time()) % TOTP_STEP
+
+def next_aligned_deadline(after, offset=0, step=None):
+    """أول حد لخطوة TOTP (مضافاً إليه الإزاحة) لا يسبق الطابع الزمني after"""
+    step = step or TOTP_STEP
+    return math.ceil((after - offset) / step) * step + offset
+
+def get_schedule_alignment(group_config):
+    """إرجاع إزاحة المحاذاة مع خطوات TOTP للمجموعة أو None إذا كانت المحاذاة معطلة"""
+    if not group_config.get("align_to_totp", False):
+        return None
+    offset = group_config.get("send_offset", 0)
+    try:
+        offset = float(offset)
+    except (TypeError, ValueError):
+        offset = math.nan
+    if not math.isfinite(offset):
+        _warn_config_once(f"قيمة غير صالحة للحقل send_offset في إعدادات المجموعة: {group_config.get('send_offset')!r}، سيتم استخدام 0")
+        return 0
+    return offset % TOTP_STEP
+
+_config_warnings = {"version": None, "seen": set()}
+
+def _warn_config_once(message):
+    """تسجيل تحذير عن قيمة غير صالحة في الإعدادات مرة واحدة لكل إصدار منها"""
+    version = get_config_version()
+    if _config_warnings["version"] != version:
+        _config_warnings["version"] = version
+        _config_warnings["seen"].clear()
+    if message not in _config_warnings["seen"]:
+        _config_warnings["seen"].add(message)
+        logger.warning(message)
+
+def get_quota_policy(group_config):
+    """سياسة حصص Copy Code للمجموعة من الحقل "quota" مع القيم الافتراضية
+
+    daily: محاولات كل يوم بتوقيت المجموعة (0 = DEFAULT_ATTEMPTS، فالحد اليومي مطبق دائماً)،
+    rolling_limit/rolling_hours: حد لكل مستخدم خلال آخر N ساعة، per_step: حد الرموز التي تُرسل
+    من المجموعة في خطوة TOTP الواحدة (0 = بدون حد لهذين الحدين).
+    """
+    quota = group_config.get("quota") or {}
+    policy = {"daily": DEFAULT_ATTEMPTS, "rolling_hours": 0, "rolling_limit": 0, "per_step": 0}
+    if not isinstance(quota, dict):
+        _warn_config_once(f"قيمة غير صالحة للحقل quota في إعدادات المجموعة: {quota!r}، سيتم استخدام القيم الافتراضية")
+        return policy
+    for key, default in policy.items():
+        try:
+            policy[key] = max(0, int(quota.get(key, default)))
+        except (TypeError, ValueError):
+            _warn_config_once(f"قيمة غير صالحة للحصة {key} في إعدادات المجموعة: {quota.get(key)!r}")
+    # المحاولات اليومية تُخزن كرصيد متبقٍ لكل مستخدم، فلا معنى لـ "بدون حد" هنا
+    policy["daily"] = policy["daily"] or DEFAULT_ATTEMPTS
+    return policy
+
+def group_today(group_config):
+    """تاريخ اليوم بصيغة reset_date حسب المنطقة الزمنية للمجموعة"""
+    return clock.today(tz.gettz(group_config.get("timezone", "UTC")))
 
     # وظائف البوت الأساسية
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """التعامل مع أمر /start"""
     user = update.effective_user
+    # بدأ المستخدم محادثة مع البوت، لذا أصبح بالإمكان مراسلته خاصة
+    dm_unreachable.discard(user.id)
     await update.message.reply_text(
         f"مرحباً {user.first_name}! 👋 هذا بوت المصادقة الثنائية 2FA.\n"
         f"إذا كنت مسؤولاً، يمكنك استخدام الأمر /admin للوصول إلى لوحة التحكم."
@@ -139,7 +1352,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """التعامل مع أمر /admin"""
     user_id = update.effective_user.id
     
-    if not is_admin(user_id):
+    if not await is_admin(user_id):
         await update.message.reply_text("عذراً، هذا الأمر متاح للمسؤولين فقط. 🚫")
         return ConversationHandler.END
     
@@ -157,16 +1370,51 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return MAIN_MENU
 
+# أدوات تقسيم الصفحات في لوحة الإدارة
+def parse_page_cursor(data, page_prefix):
+    """استخراج مؤشر الصفحة من بيانات الزر: (after, before)"""
+    rest = data[len(page_prefix):]
+    if rest.startswith(">"):
+        return rest[1:], None
+    if rest.startswith("<"):
+        return None, rest[1:]
+    return None, None
+
+def page_navigation_row(page_keys, has_prev, has_next, page_prefix):
+    """صف أزرار التنقل بين الصفحات (فارغ إذا كانت صفحة واحدة)"""
+    row = []
+    if has_prev:
+        row.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"{page_prefix}<{page_keys[0]}"))
+    if has_next:
+        row.append(InlineKeyboardButton("التالي ➡️", callback_data=f"{page_prefix}>{page_keys[-1]}"))
+    return row
+
+def groups_page_keyboard(groups, data, page_prefix, item_button):
+    """أزرار صفحة من المجموعات بترتيب ثابت مع صف التنقل"""
+    keys = sorted(groups)
+    after, before = parse_page_cursor(data, page_prefix)
+    page, has_prev, has_next = paginate_sorted(keys, after, before)
+    if not page:
+        # المؤشر لم يعد صالحاً (مثلاً بعد حذف مجموعات): العودة للصفحة الأولى
+        page, has_prev, has_next = paginate_sorted(keys)
+    keyboard = [[item_button(group_id)] for group_id in page]
+    nav = page_navigation_row(page, has_prev, has_next, page_prefix)
+    if nav:
+        keyboard.append(nav)
+    return keyboard
+
 # وظائف إدارة المجموعات
 async def manage_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إدارة المجموعات وTOTP_SECRET"""
     query = update.callback_query
     await query.answer()
     
+    paused = len(group_breakers.open_groups())
     keyboard = [
         [InlineKeyboardButton("➕ إضافة مجموعة", callback_data="add_group")],
         [InlineKeyboardButton("🗑️ حذف مجموعة", callback_data="delete_group")],
         [InlineKeyboardButton("✏️ تعديل مجموعة", callback_data="edit_group")],
+        [InlineKeyboardButton(f"🩺 حالة الإرسال ({paused} متوقفة)", callback_data="group_health")],
         [InlineKeyboardButton("🔙 العودة", callback_data="back_to_main")]
     ]
     
@@ -175,6 +1423,46 @@ async def manage_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return MANAGE_GROUPS
 
+async def group_health(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """عرض المجموعات الموقوفة مؤقتاً بسبب فشل الإرسال مع إمكانية إعادة تعيينها"""
+    query = update.callback_query
+    await query.answer()
+    
+    paused = group_breakers.open_groups()
+    if not paused:
+        keyboard = [[InlineKeyboardButton("🔙 العودة", callback_data="manage_groups")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text("جميع المجموعات تستقبل الرسائل بشكل طبيعي. ✅", reply_markup=reply_markup)
+        return MANAGE_GROUPS
+    
+    keyboard = groups_page_keyboard(
+        paused, query.data, "group_health",
+        lambda group_id: InlineKeyboardButton(
+            f"🔴 {group_id} ({paused[group_id]['failures']} فشل) - إعادة تعيين",
+            callback_data=f"reset_breaker_{group_id}"
+        )
+    )
+    keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="manage_groups")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await query.edit_message_text(
+        f"المجموعات الموقوفة مؤقتاً بسبب فشل الإرسال: {len(paused)} ⚠️\n"
+        "يعيد البوت المحاولة تلقائياً بعد مدة تتضاعف مع كل فشل. اضغط على مجموعة لاستئناف الإرسال إليها فوراً: 👇",
+        reply_markup=reply_markup
+    )
+    
+    return MANAGE_GROUPS
+
+async def reset_breaker(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """استئناف الإرسال إلى مجموعة موقوفة مؤقتاً"""
+    query = update.callback_query
+    group_id = query.data.replace("reset_breaker_", "")
+    
+    if group_breakers.reset(group_id):
+        logger.info(f"تمت إعادة تعيين حالة الإرسال للمجموعة {group_id} من لوحة الإدارة")
+    
+    return await group_health(update, context)
+
 async def add_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إضافة مجموعة جديدة"""
     query = update.callback_query
@@ -221,16 +1509,16 @@ async def process_add_secret(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return ADD_SECRET
     
-    config = load_config()
+    config = await persistence.load_config()
     config["groups"][group_id] = {
         "totp_secret": totp_secret,
         "interval": 600,
         "message_style": 1,
         "timezone": "UTC" # إضافة المنطقة الزمنية الافتراضية
     }
-    save_config(config)
+    await persistence.save_config(config)
     
-    await start_periodic_task(context.application, group_id) # تمرير application بدلاً من context
+    await config_reloader.reconcile(context.application)
     
     keyboard = [
         [InlineKeyboardButton("🔙 العودة إلى إدارة المجموعات", callback_data="manage_groups")],
@@ -250,7 +1538,7 @@ async def delete_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    config = load_config()
+    config = await persistence.load_config()
     groups = config.get("groups", {})
     
     if not groups:
@@ -259,9 +1547,10 @@ async def delete_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("لا توجد مجموعات مضافة حالياً. 🤷‍♂️", reply_markup=reply_markup)
         return MANAGE_GROUPS
     
-    keyboard = []
-    for group_id in groups:
-        keyboard.append([InlineKeyboardButton(f"👥 المجموعة: {group_id}", callback_data=f"del_group_{group_id}")])
+    keyboard = groups_page_keyboard(
+        groups, query.data, "delete_group",
+        lambda group_id: InlineKeyboardButton(f"👥 المجموعة: {group_id}", callback_data=f"del_group_{group_id}")
+    )
     
     keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="manage_groups")])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -277,12 +1566,11 @@ async def process_delete_group(update: Update, context: ContextTypes.DEFAULT_TYP
     
     group_id = query.data.replace("del_group_", "")
     
-    await stop_periodic_task(context.application, group_id) # تمرير application بدلاً من context
-    
-    config = load_config()
+    config = await persistence.load_config()
     if group_id in config["groups"]:
         del config["groups"][group_id]
-        save_config(config)
+        await persistence.save_config(config)
+    await config_reloader.reconcile(context.application)
     
     keyboard = [
         [InlineKeyboardButton("🔙 العودة إلى إدارة المجموعات", callback_data="manage_groups")],
@@ -299,7 +1587,7 @@ async def edit_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    config = load_config()
+    config = await persistence.load_config()
     groups = config.get("groups", {})
     
     if not groups:
@@ -308,9 +1596,10 @@ async def edit_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("لا توجد مجموعات مضافة حالياً. 🤷‍♂️", reply_markup=reply_markup)
         return MANAGE_GROUPS
     
-    keyboard = []
-    for group_id in groups:
-        keyboard.append([InlineKeyboardButton(f"👥 المجموعة: {group_id}", callback_data=f"edit_group_{group_id}")])
+    keyboard = groups_page_keyboard(
+        groups, query.data, "edit_group",
+        lambda group_id: InlineKeyboardButton(f"👥 المجموعة: {group_id}", callback_data=f"edit_group_{group_id}")
+    )
     
     keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="manage_groups")])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -348,10 +1637,11 @@ async def process_edit_secret(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return EDIT_SECRET
     
-    config = load_config()
+    config = await persistence.load_config()
     if group_id in config["groups"]:
         config["groups"][group_id]["totp_secret"] = totp_secret
-        save_config(config)
+        await persistence.save_config(config)
+        await config_reloader.reconcile(context.application)
     
     keyboard = [
         [InlineKeyboardButton("🔙 العودة إلى إدارة المجموعات", callback_data="manage_groups")],
@@ -372,7 +1662,7 @@ async def manage_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    config = load_config()
+    config = await persistence.load_config()
     groups = config.get("groups", {})
     
     if not groups:
@@ -381,11 +1671,11 @@ async def manage_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("لا توجد مجموعات مضافة حالياً. 🤷‍♂️", reply_markup=reply_markup)
         return MAIN_MENU
     
-    keyboard = []
-    for group_id in groups:
-        interval = config["groups"][group_id].get("interval", 600)
-        interval_text = format_interval(interval)
-        keyboard.append([InlineKeyboardButton(f"👥 المجموعة: {group_id} ({interval_text})", callback_data=f"interval_{group_id}")])
+    def interval_button(group_id):
+        interval_text = format_interval(groups[group_id].get("interval", 600))
+        return InlineKeyboardButton(f"👥 المجموعة: {group_id} ({interval_text})", callback_data=f"interval_{group_id}")
+    
+    keyboard = groups_page_keyboard(groups, query.data, "manage_interval", interval_button)
     
     keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="back_to_main")])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -402,6 +1692,11 @@ async def process_manage_interval(update: Update, context: ContextTypes.DEFAULT_
     group_id = query.data.replace("interval_", "")
     context.user_data["interval_group_id"] = group_id
     
+    config = await persistence.load_config()
+    current_interval = config["groups"][group_id].get("interval", 600)
+    aligned = config["groups"][group_id].get("align_to_totp", False)
+    align_text = "🎯 المحاذاة مع خطوات TOTP: مفعلة ✅" if aligned else "🎯 المحاذاة مع خطوات TOTP: معطلة ❌"
+    
     keyboard = [
         [InlineKeyboardButton("⏳ 1 دقيقة", callback_data="set_interval_60")],
         [InlineKeyboardButton("⏳ 5 دقائق", callback_data="set_interval_300")],
@@ -414,14 +1709,12 @@ async def process_manage_interval(update: Update, context: ContextTypes.DEFAULT_
         [InlineKeyboardButton("⏳ 24 ساعة", callback_data="set_interval_86400")],
         [InlineKeyboardButton("🚫 إيقاف التكرار", callback_data="stop_interval")],
         [InlineKeyboardButton("▶️ بدء التكرار", callback_data="start_interval")],
+        [InlineKeyboardButton(align_text, callback_data="toggle_align")],
         [InlineKeyboardButton("🔙 العودة", callback_data="manage_interval")]
     ]
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    config = load_config()
-    current_interval = config["groups"][group_id].get("interval", 600)
-    
     await query.edit_message_text(
         f"👥 المجموعة: {group_id}\n"
         f"⏱️ فترة التكرار الحالية: {format_interval(current_interval)}\n\n"
@@ -466,16 +1759,15 @@ async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
         
-    else:
-        interval = int(query.data.replace("set_interval_", ""))
-        
-        config = load_config()
+    elif query.data == "toggle_align":
+        config = await persistence.load_config()
+        aligned = False
         if group_id in config["groups"]:
-            config["groups"][group_id]["interval"] = interval
-            save_config(config)
+            aligned = not config["groups"][group_id].get("align_to_totp", False)
+            config["groups"][group_id]["align_to_totp"] = aligned
+            await persistence.save_config(config)
         
-        await stop_periodic_task(context.application, group_id) # تمرير application
-        await start_periodic_task(context.application, group_id) # تمرير application
+        await config_reloader.reconcile(context.application)
         
         keyboard = [
             [InlineKeyboardButton("🔙 العودة إلى إدارة فترة التكرار", callback_data="manage_interval")],
@@ -483,20 +1775,45 @@ async def set_interval(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
         
         reply_markup = InlineKeyboardMarkup(keyboard)
+        status = "تفعيل" if aligned else "تعطيل"
         await query.edit_message_text(
-            f"تم تعيين فترة التكرار للمجموعة {group_id} إلى {format_interval(interval)} بنجاح! ✅",
+            f"تم {status} محاذاة الإرسال مع خطوات TOTP للمجموعة {group_id} بنجاح! 🎯",
             reply_markup=reply_markup
         )
-    
-    return MAIN_MENU
-
-# وظائف إدارة شكل الرسالة
-async def manage_message_style(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        
+    else:
+        interval = int(query.data.replace("set_interval_", ""))
+        
+        config = await persistence.load_config()
+        if group_id in config["groups"]:
+            config["groups"][group_id]["interval"] = interval
+            await persistence.save_config(config)
+        
+        await config_reloader.reconcile(context.application)
+        if group_id not in scheduler:
+            # نفس الفاصل لمجموعة أُوقف تكرارها: لا فرق في الإعدادات لكن يجب استئنافها
+            await reschedule_periodic_task(context.application, group_id)
+        
+        keyboard = [
+            [InlineKeyboardButton("🔙 العودة إلى إدارة فترة التكرار", callback_data="manage_interval")],
+            [InlineKeyboardButton("🏠 العودة إلى القائمة الرئيسية", callback_data="back_to_main")]
+        ]
+        
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await query.edit_message_text(
+            f"تم تعيين فترة التكرار للمجموعة {group_id} إلى {format_interval(interval)} بنجاح! ✅",
+            reply_markup=reply_markup
+        )
+    
+    return MAIN_MENU
+
+# وظائف إدارة شكل الرسالة
+async def manage_message_style(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """إدارة شكل/توقيت الرسالة"""
     query = update.callback_query
     await query.answer()
     
-    config = load_config()
+    config = await persistence.load_config()
     groups = config.get("groups", {})
     
     if not groups:
@@ -505,11 +1822,12 @@ async def manage_message_style(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text("لا توجد مجموعات مضافة حالياً. 🤷‍♂️", reply_markup=reply_markup)
         return MAIN_MENU
     
-    keyboard = []
-    for group_id in groups:
-        style = config["groups"][group_id].get("message_style", 1)
-        timezone = config["groups"][group_id].get("timezone", "UTC")
-        keyboard.append([InlineKeyboardButton(f"👥 المجموعة: {group_id} (النمط {style}, {timezone})", callback_data=f"style_{group_id}")])
+    def style_button(group_id):
+        style = groups[group_id].get("message_style", 1)
+        timezone = groups[group_id].get("timezone", "UTC")
+        return InlineKeyboardButton(f"👥 المجموعة: {group_id} (النمط {style}, {timezone})", callback_data=f"style_{group_id}")
+    
+    keyboard = groups_page_keyboard(groups, query.data, "manage_message_style", style_button)
     
     keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="back_to_main")])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -541,7 +1859,7 @@ async def process_manage_message_style(update: Update, context: ContextTypes.DEF
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    config = load_config()
+    config = await persistence.load_config()
     current_style = config["groups"][group_id].get("message_style", 1)
     current_timezone = config["groups"][group_id].get("timezone", "UTC")
     
@@ -564,21 +1882,21 @@ async def set_message_style(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     group_id = context.user_data.get("style_group_id")
-    config = load_config()
+    config = await persistence.load_config()
     message = ""
     
     if query.data.startswith("set_style_"):
         style = int(query.data.replace("set_style_", ""))
         if group_id in config["groups"]:
             config["groups"][group_id]["message_style"] = style
-            save_config(config)
+            await persistence.save_config(config)
         message = f"تم تعيين نمط الرسالة للمجموعة {group_id} إلى النمط {style} بنجاح! ✅"
         
     elif query.data.startswith("set_timezone_"):
         timezone = query.data.replace("set_timezone_", "")
         if group_id in config["groups"]:
             config["groups"][group_id]["timezone"] = timezone
-            save_config(config)
+            await persistence.save_config(config)
         timezone_name = "غرينتش (UTC)" if timezone == "UTC" else "غزة (Asia/Gaza)"
         message = f"تم تعيين توقيت الرسالة للمجموعة {group_id} إلى توقيت {timezone_name} بنجاح! ✅"
     
@@ -613,7 +1931,7 @@ async def select_group_for_user(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     
-    config = load_config()
+    config = await persistence.load_config()
     groups = config.get("groups", {})
     
     if not groups:
@@ -622,9 +1940,10 @@ async def select_group_for_user(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text("لا توجد مجموعات مضافة حالياً. 🤷‍♂️", reply_markup=reply_markup)
         return MANAGE_USER_ATTEMPTS
     
-    keyboard = []
-    for group_id in groups:
-        keyboard.append([InlineKeyboardButton(f"👥 المجموعة: {group_id}", callback_data=f"select_users_{group_id}")])
+    keyboard = groups_page_keyboard(
+        groups, query.data, "select_group_for_user",
+        lambda group_id: InlineKeyboardButton(f"👥 المجموعة: {group_id}", callback_data=f"select_users_{group_id}")
+    )
     
     keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="manage_user_attempts")])
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -633,38 +1952,121 @@ async def select_group_for_user(update: Update, context: ContextTypes.DEFAULT_TY
     
     return SELECT_GROUP_FOR_USER
 
+async def users_page_markup(group_id, data, page_prefix, prefix=None, back_callback="select_group_for_user"):
+    """بناء صفحة من مستخدمي المجموعة؛ يرجع (عدد المستخدمين في الصفحة، لوحة الأزرار)"""
+    after, before = parse_page_cursor(data, page_prefix)
+    store = get_async_store()
+    page, has_prev, has_next = await store.list_group_users_page(group_id, after, before, prefix=prefix)
+    if not page and (after is not None or before is not None):
+        page, has_prev, has_next = await store.list_group_users_page(group_id, prefix=prefix)
+    
+    keyboard = []
+    for user_id, record in page:
+        keyboard.append([InlineKeyboardButton(
+            f"👤 المستخدم: {user_id} (المحاولات: {record['remaining']})",
+            callback_data=f"manage_user_{user_id}"
+        )])
+    
+    nav = page_navigation_row([user_id for user_id, _ in page], has_prev, has_next, page_prefix)
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔍 بحث عن مستخدم", callback_data="search_user")])
+    keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data=back_callback)])
+    return len(page), InlineKeyboardMarkup(keyboard)
+
 async def select_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """اختيار المستخدم لإدارة المحاولات"""
     query = update.callback_query
     await query.answer()
     
-    group_id = query.data.replace("select_users_", "")
+    payload = query.data.replace("select_users_", "", 1)
+    group_id = re.split("[<>]", payload, maxsplit=1)[0]
     context.user_data["attempts_group_id"] = group_id
+    context.user_data.pop("user_search_prefix", None)
     
-    users = load_users()
-    group_users = {}
-    for user_id, user_data in users.items():
-        if "attempts" in user_data and group_id in user_data["attempts"]:
-            group_users[user_id] = user_data
+    total = await get_async_store().count_group_users(group_id)
     
-    if not group_users:
+    if not total:
         keyboard = [[InlineKeyboardButton("🔙 العودة", callback_data="select_group_for_user")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("لا يوجد مستخدمون في هذه المجموعة حالياً. 🤷‍♂️", reply_markup=reply_markup)
         return SELECT_GROUP_FOR_USER
     
-    keyboard = []
-    for user_id, user_data in group_users.items():
-        remaining = user_data["attempts"][group_id]["remaining"]
-        keyboard.append([InlineKeyboardButton(
-            f"👤 المستخدم: {user_id} (المحاولات: {remaining})",
-            callback_data=f"manage_user_{user_id}"
-        )])
+    _, reply_markup = await users_page_markup(group_id, query.data, f"select_users_{group_id}")
+    
+    await query.edit_message_text(
+        f"👥 عدد المستخدمين: {total}\n"
+        "اختر المستخدم لإدارة المحاولات: 👇",
+        reply_markup=reply_markup
+    )
+    
+    return SELECT_USER
+
+async def search_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """طلب معرف المستخدم أو بادئته للبحث"""
+    query = update.callback_query
+    await query.answer()
     
-    keyboard.append([InlineKeyboardButton("🔙 العودة", callback_data="select_group_for_user")])
+    group_id = context.user_data.get("attempts_group_id")
+    keyboard = [[InlineKeyboardButton("🔙 العودة", callback_data=f"select_users_{group_id}")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    await query.edit_message_text("اختر المستخدم لإدارة المحاولات: 👇", reply_markup=reply_markup)
+    await query.edit_message_text(
+        f"يرجى إدخال معرف المستخدم (User ID) أو بدايته للبحث في المجموعة {group_id}: 🔍",
+        reply_markup=reply_markup
+    )
+    
+    return SEARCH_USER
+
+async def process_search_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالجة البحث عن مستخدم بالمعرف أو ببادئته"""
+    prefix = update.message.text.strip()
+    group_id = context.user_data.get("attempts_group_id")
+    
+    if not prefix.isdigit():
+        await update.message.reply_text(
+            "يرجى إدخال معرف مستخدم صالح أو بدايته (أرقام فقط): ❌🔍"
+        )
+        return SEARCH_USER
+    
+    context.user_data["user_search_prefix"] = prefix
+    count, reply_markup = await users_page_markup(
+        group_id, "user_search", "user_search", prefix=prefix, back_callback=f"select_users_{group_id}"
+    )
+    
+    if not count:
+        keyboard = [
+            [InlineKeyboardButton("🔍 بحث جديد", callback_data="search_user")],
+            [InlineKeyboardButton("🔙 العودة", callback_data=f"select_users_{group_id}")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await update.message.reply_text(f"لا يوجد مستخدمون يطابقون البحث: {prefix} 🤷‍♂️", reply_markup=reply_markup)
+        return SELECT_USER
+    
+    await update.message.reply_text(
+        f"🔍 نتائج البحث عن: {prefix}\n"
+        "اختر المستخدم لإدارة المحاولات: 👇",
+        reply_markup=reply_markup
+    )
+    
+    return SELECT_USER
+
+async def user_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """التنقل بين صفحات نتائج البحث"""
+    query = update.callback_query
+    await query.answer()
+    
+    group_id = context.user_data.get("attempts_group_id")
+    prefix = context.user_data.get("user_search_prefix")
+    _, reply_markup = await users_page_markup(
+        group_id, query.data, "user_search", prefix=prefix, back_callback=f"select_users_{group_id}"
+    )
+    
+    await query.edit_message_text(
+        f"🔍 نتائج البحث عن: {prefix}\n"
+        "اختر المستخدم لإدارة المحاولات: 👇",
+        reply_markup=reply_markup
+    )
     
     return SELECT_USER
 
@@ -677,12 +2079,12 @@ async def manage_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["attempts_user_id"] = user_id
     
     group_id = context.user_data.get("attempts_group_id")
-    users = load_users()
+    user_data = await get_async_store().get_user(user_id)
     
-    if user_id in users and "attempts" in users[user_id] and group_id in users[user_id]["attempts"]:
-        remaining = users[user_id]["attempts"][group_id]["remaining"]
-        reset_date = users[user_id]["attempts"][group_id]["reset_date"]
-        banned = users[user_id].get("banned", False)
+    if user_data and group_id in user_data.get("attempts", {}):
+        remaining = user_data["attempts"][group_id]["remaining"]
+        reset_date = user_data["attempts"][group_id]["reset_date"]
+        banned = user_data.get("banned", False)
         
         status = "محظور 🚫" if banned else "نشط ✅"
         ban_button_text = "✅ إلغاء حظر المستخدم" if banned else "🚫 حظر المستخدم"
@@ -721,16 +2123,13 @@ async def toggle_ban(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = context.user_data.get("attempts_user_id")
     group_id = context.user_data.get("attempts_group_id")
     
-    users = load_users()
+    async with user_locks(user_id):
+        banned = await get_async_store().toggle_ban(user_id)
     message = ""
     
-    if user_id in users:
-        current_ban = users[user_id].get("banned", False)
-        users[user_id]["banned"] = not current_ban
-        save_users(users)
-        
-        status = "محظور 🚫" if not current_ban else "نشط ✅"
-        action = "حظر" if not current_ban else "إلغاء حظر"
+    if banned is not None:
+        status = "محظور 🚫" if banned else "نشط ✅"
+        action = "حظر" if banned else "إلغاء حظر"
         message = f"تم {action} المستخدم {user_id} بنجاح! الحالة الآن: {status}"
     else:
         message = f"لم يتم العثور على المستخدم {user_id}. 🤷‍♂️"
@@ -779,18 +2178,10 @@ async def process_add_attempts(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = context.user_data.get("attempts_user_id")
     group_id = context.user_data.get("attempts_group_id")
     
-    users = load_users()
-    
-    if user_id not in users:
-        users[user_id] = {"attempts": {}, "banned": False}
-    if "attempts" not in users[user_id]:
-        users[user_id]["attempts"] = {}
-    if group_id not in users[user_id]["attempts"]:
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        users[user_id]["attempts"][group_id] = {"remaining": 0, "reset_date": today}
-    
-    users[user_id]["attempts"][group_id]["remaining"] += attempts
-    save_users(users)
+    config = await persistence.load_config(readonly=True)
+    today = group_today(config["groups"].get(group_id, {}))
+    async with user_locks(user_id):
+        await get_async_store().add_attempts(user_id, group_id, attempts, today)
     
     keyboard = [
         [InlineKeyboardButton("🔙 العودة إلى إدارة المستخدم", callback_data=f"manage_user_{user_id}")],
@@ -833,17 +2224,11 @@ async def process_remove_attempts(update: Update, context: ContextTypes.DEFAULT_
     user_id = context.user_data.get("attempts_user_id")
     group_id = context.user_data.get("attempts_group_id")
     
-    users = load_users()
+    async with user_locks(user_id):
+        removed_count = await get_async_store().remove_attempts(user_id, group_id, attempts)
     message = ""
     
-    if (user_id in users and "attempts" in users[user_id] and 
-            group_id in users[user_id]["attempts"]):
-        
-        current = users[user_id]["attempts"][group_id]["remaining"]
-        removed_count = min(attempts, current)
-        users[user_id]["attempts"][group_id]["remaining"] = max(0, current - attempts)
-        save_users(users)
-        
+    if removed_count is not None:
         message = f"تم حذف {removed_count} محاولات من المستخدم {user_id} بنجاح! ✅"
     else:
         message = f"لم يتم العثور على بيانات المحاولات للمستخدم {user_id}. 🤷‍♂️"
@@ -872,7 +2257,7 @@ async def manage_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    config = load_config()
+    config = await persistence.load_config()
     admins = config.get("admins", [ADMIN_ID])
     admins_text = "\n".join([f"- 👮 {admin}" for admin in admins])
     
@@ -906,14 +2291,14 @@ async def process_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ADD_ADMIN
     
-    config = load_config()
+    config = await persistence.load_config()
     message = ""
     
     if admin_id in config["admins"]:
         message = f"المستخدم {admin_id} مسؤول بالفعل. ✅👮"
     else:
         config["admins"].append(admin_id)
-        save_config(config)
+        await persistence.save_config(config)
         message = f"تم إضافة المستخدم {admin_id} كمسؤول بنجاح! 🎉👮"
     
     keyboard = [
@@ -931,7 +2316,7 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    config = load_config()
+    config = await persistence.load_config()
     admins = config.get("admins", [ADMIN_ID])
     
     # التأكد من وجود مسؤولين آخرين غير المسؤول الرئيسي
@@ -964,14 +2349,14 @@ async def process_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYP
     
     admin_id = int(query.data.replace("del_admin_", ""))
     
-    config = load_config()
+    config = await persistence.load_config()
     message = ""
     
     if admin_id == ADMIN_ID:
         message = "لا يمكن إزالة المسؤول الرئيسي. 🚫"
     elif admin_id in config["admins"]:
         config["admins"].remove(admin_id)
-        save_config(config)
+        await persistence.save_config(config)
         message = f"تم إزالة المسؤول {admin_id} بنجاح! ✅👮"
     else:
         message = f"المستخدم {admin_id} ليس مسؤولاً. 🤷‍♂️"
@@ -1020,75 +2405,871 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return ConversationHandler.END
 
+# محرك رموز TOTP
+class TotpEngine:
+    """يحتفظ بكائن TOTP المفكك لكل مجموعة ويخزن رمز كل خطوة زمنية مؤقتاً
+
+    يُحسب الرمز مرة واحدة لكل (مجموعة، خطوة)، وتُحذف الخطوات القديمة عند الانتقال
+    للخطوة التالية، ويُحسب رمز الخطوة التالية مسبقاً قبيل الحد الفاصل.
+    """
+
+    def __init__(self, step=TOTP_STEP, precompute_window=2):
+        self.step = step
+        self.precompute_window = precompute_window
+        self._totps = {}  # group_id -> (secret, pyotp.TOTP)
+        self._codes = {}  # group_id -> {رقم الخطوة: الرمز}
+        self._runner = None
+
+    def _get_totp(self, group_id, secret):
+        cached = self._totps.get(group_id)
+        if cached is None or cached[0] != secret:
+            cached = self._totps[group_id] = (secret, pyotp.TOTP(secret, interval=self.step))
+            self._codes.pop(group_id, None)
+        return cached[1]
+
+    def _code_for_step(self, group_id, totp, step_index):
+        codes = self._codes.setdefault(group_id, {})
+        code = codes.get(step_index)
+        if code is None:
+            code = totp.generate_otp(step_index)
+            # حذف رموز الخطوات المنتهية
+            for old in [k for k in codes if k < step_index]:
+                del codes[old]
+            codes[step_index] = code
+        return code
+
+    def get_code(self, group_id, secret, for_time=None):
+        """إرجاع (الرمز، الثواني المتبقية لصلاحيته) للمجموعة"""
+        now = clock.time() if for_time is None else for_time
+        step_index = int(now // self.step)
+        totp = self._get_totp(group_id, secret)
+        code = self._code_for_step(group_id, totp, step_index)
+        remaining = self.step - int(now) % self.step
+        if remaining <= self.precompute_window:
+            self._code_for_step(group_id, totp, step_index + 1)
+        return code, remaining
+
+    def invalidate(self, group_id):
+        """حذف الحالة المخزنة لمجموعة (عند حذفها أو تغيير السر)"""
+        self._totps.pop(group_id, None)
+        self._codes.pop(group_id, None)
+
+    def precompute_next(self, for_time=None):
+        """حساب رمز الخطوة التالية لجميع المجموعات المعروفة وحذف الخطوات المنتهية"""
+        now = clock.time() if for_time is None else for_time
+        next_step = int(now // self.step) + 1
+        for group_id, (_, totp) in list(self._totps.items()):
+            try:
+                self._code_for_step(group_id, totp, next_step)
+            except Exception as e:
+                logger.error(f"خطأ في الحساب المسبق لرمز TOTP للمجموعة {group_id}: {e}")
+                self.invalidate(group_id)
+
+    def start(self):
+        """بدء مهمة الحساب المسبق قبيل كل حد خطوة"""
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._runner
+            self._runner = None
+
+    async def _run(self):
+        while True:
+            now = clock.time()
+            boundary = next_aligned_deadline(now + self.precompute_window, 0, self.step)
+            await clock.sleep(max(0, boundary - self.precompute_window - now))
+            self.precompute_next()
+            # تجاوز نافذة الحساب المسبق قبل الدورة التالية
+            await clock.sleep(self.precompute_window)
+
+
+totp_engine = TotpEngine()
+
+# طابور الرسائل الصادرة مع التحكم بالمعدل
+class TokenBucket:
+    """دلو رموز بنظام الحجز: take() يحجز رمزاً ويرجع مدة الانتظار اللازمة قبل استخدامه"""
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self):
+        """حجز رمز واحد؛ يرجع عدد الثواني الواجب انتظارها (0 إذا كان متاحاً فوراً)"""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0
+        return -self._tokens / self.rate
+
+    def try_take(self, now):
+        """أخذ رمز فقط إذا كان متاحاً الآن (دون حجز)؛ يرجع True عند النجاح"""
+        self._refill(now)
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def pause(self, seconds):
+        """تعليق الدلو لمدة محددة (مثلاً بعد RetryAfter)"""
+        now = time.monotonic()
+        self._refill(now)
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+    @property
+    def idle(self):
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+
+class OutboundQueue:
+    """طابور إرسال بمسارين (رسائل خاصة / بث للمجموعات) مع حدود معدل عامة ولكل محادثة
+
+    للرسائل الخاصة عمالها ومسارها الخاص، ويُقيد البث بحصة من المعدل العام
+    حتى لا تتأخر رموز المستخدمين خلف رسائل المجموعات.
+    لا ينام العامل أبداً في انتظار محادثة بعينها: إذا لم يتوفر رمز في دلو المحادثة
+    أو طلب Telegram الانتظار (RetryAfter) يُؤجَّل الطلب بمؤقت على حلقة الأحداث
+    (كومة مرتبة بموعد الجاهزية) ويعود إلى المسار عند حلوله، ويتفرغ العامل فوراً لبقية المحادثات.
+    """
+
+    LANE_DM = "dm"
+    LANE_BROADCAST = "broadcast"
+
+    def __init__(self, global_rate=25, broadcast_share=0.7, group_rate=20 / 60, group_burst=3,
+                 private_rate=1, private_burst=3, workers_per_lane=4, max_retries=3, max_chat_buckets=10000):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._broadcast = TokenBucket(global_rate * broadcast_share, global_rate * broadcast_share)
+        self._group_rate = (group_rate, group_burst)
+        self._private_rate = (private_rate, private_burst)
+        self._chat_buckets = collections.OrderedDict()
+        self._max_chat_buckets = max_chat_buckets
+        self._workers_per_lane = workers_per_lane
+        self._max_retries = max_retries
+        self._queues = {}
+        self._workers = []
+        self._deferred = {}  # رقم تسلسلي -> (المسار, المؤقت, الطلب)
+        self._deferred_seq = itertools.count()
+
+    @property
+    def running(self):
+        return bool(self._workers)
+
+    def start(self):
+        """تشغيل العمال على حلقة الأحداث الحالية"""
+        if self.running:
+            return
+        for lane in (self.LANE_DM, self.LANE_BROADCAST):
+            self._queues[lane] = asyncio.Queue()
+            for _ in range(self._workers_per_lane):
+                self._workers.append(asyncio.create_task(self._worker(lane)))
+
+    async def stop(self):
+        """إيقاف العمال وإلغاء الطلبات المعلقة والمؤجلة"""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        pending = [item for _, handle, item in self._deferred.values() if not handle.cancel()]
+        self._deferred.clear()
+        for q in self._queues.values():
+            while not q.empty():
+                pending.append(q.get_nowait())
+        for item in pending:
+            if not item["future"].done():
+                item["future"].cancel()
+        self._queues = {}
+
+    def qsize(self, lane):
+        """عدد الطلبات المنتظرة على المسار، بما فيها المؤجلة"""
+        q = self._queues.get(lane)
+        deferred = sum(1 for deferred_lane, _, _ in self._deferred.values() if deferred_lane == lane)
+        return (q.qsize() if q else 0) + deferred
+
+    async def send(self, lane, func, **kwargs):
+        """جدولة استدعاء API (مثل bot.send_message) على المسار المحدد وانتظار نتيجته"""
+        if not self.running:
+            return await self._invoke(func, kwargs)
+        future = asyncio.get_running_loop().create_future()
+        # reserved: رمز دلو المحادثة محجوز مسبقاً لهذا الطلب (بعد تأجيله)
+        await self._queues[lane].put({"func": func, "kwargs": kwargs, "future": future,
+                                      "attempt": 0, "reserved": False})
+        return await future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            rate, burst = self._group_rate if int(chat_id) < 0 else self._private_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, burst)
+            # إزالة دلاء المحادثات الخاملة الأقدم
+            while len(self._chat_buckets) > self._max_chat_buckets:
+                oldest_id, oldest = next(iter(self._chat_buckets.items()))
+                if not oldest.idle:
+                    break
+                del self._chat_buckets[oldest_id]
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _defer(self, lane, item, delay):
+        """إعادة الطلب إلى مساره بعد delay ثانية دون حجز أي عامل"""
+        key = next(self._deferred_seq)
+
+        def ready():
+            self._deferred.pop(key, None)
+            queue = self._queues.get(lane)
+            if queue is not None:
+                queue.put_nowait(item)
+            elif not item["future"].done():
+                item["future"].cancel()
+
+        handle = asyncio.get_running_loop().call_later(delay, ready)
+        self._deferred[key] = (lane, handle, item)
+
+    async def _worker(self, lane):
+        queue = self._queues[lane]
+        while True:
+            item = await queue.get()
+            future = item["future"]
+            try:
+                if future.cancelled():
+                    continue
+                chat_id = item["kwargs"].get("chat_id")
+                if not item["reserved"]:
+                    wait = self._chat_bucket(chat_id).take()
+                    if wait > 0:
+                        # الرمز محجوز؛ يعود الطلب عند حلول دوره ويتفرغ العامل الآن
+                        item["reserved"] = True
+                        self._defer(lane, item, wait)
+                        continue
+                item["reserved"] = False
+                if lane == self.LANE_BROADCAST:
+                    await asyncio.sleep(self._broadcast.take())
+                await asyncio.sleep(self._global.take())
+                delay = await self._call(item)
+                if delay is not None:
+                    self._defer(lane, item, delay)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            finally:
+                queue.task_done()
+
+    @staticmethod
+    async def _invoke(func, kwargs):
+        """استدعاء API واحد مع تسجيل أخطائه في المقاييس (الزمن يُسجل في HttpPoolStats لكل الاستدعاءات)"""
+        try:
+            return await func(**kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", method=getattr(func, "__name__", "call"), error=type(e).__name__)
+            raise
+
+    async def _call(self, item):
+        """محاولة واحدة للطلب؛ ترجع مهلة إعادة المحاولة بالثواني أو None عند حسم النتيجة"""
+        future = item["future"]
+        chat_id = item["kwargs"].get("chat_id")
+        try:
+            result = await self._invoke(item["func"], item["kwargs"])
+        except RetryAfter as e:
+            item["attempt"] += 1
+            retry_after = e.retry_after
+            if isinstance(retry_after, datetime.timedelta):
+                retry_after = retry_after.total_seconds()
+            if item["attempt"] > self._max_retries:
+                if not future.done():
+                    future.set_exception(e)
+                return None
+            logger.warning(f"تجاوز حد الإرسال للمحادثة {chat_id}، إعادة المحاولة بعد {retry_after} ثانية")
+            # تعليق المحادثة طوال مدة الحظر المؤقت؛ رسائلها الأخرى تُؤجَّل بدورها عند سحبها
+            self._chat_bucket(chat_id).pause(retry_after)
+            item["reserved"] = True
+            return retry_after
+        except (TimedOut, Forbidden, BadRequest) as e:
+            # لا إعادة للمحاولة: قد تكون الرسالة قد أُرسلت أو الخطأ دائم
+            if not future.done():
+                future.set_exception(e)
+            return None
+        except NetworkError as e:
+            item["attempt"] += 1
+            if item["attempt"] > self._max_retries:
+                if not future.done():
+                    future.set_exception(e)
+                return None
+            return min(2 ** item["attempt"], 30)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return None
+        if not future.done():
+            future.set_result(result)
+        return None
+
+outbox = OutboundQueue()
+
 # وظائف المهام الدورية
+class GroupScheduler:
+    """مجدول واحد لجميع المجموعات يعمل على حلقة أحداث التطبيق
+
+    يحتفظ بكومة (heap) لمواعيد الإرسال القادمة مع حذف كسول للمدخلات القديمة،
+    لذا تتم الإضافة والإزالة وإعادة الجدولة بتعقيد O(log n).
+    المواعيد مطلقة: الموعد التالي يُحسب من الموعد السابق وليس من لحظة انتهاء الإرسال،
+    ويمكن محاذاتها مع حدود خطوات TOTP لتصل الرموز بأطول صلاحية متبقية.
+    """
+
+    def __init__(self, send=None, save=None, save_interval=SCHEDULE_SAVE_INTERVAL):
+        self._send = send  # دالة الإرسال (الافتراضي send_auth_message)؛ قابلة للاستبدال في المحاكاة
+        self._save = save  # دالة غير متزامنة لحفظ snapshot() (None = بدون حفظ)
+        self._save_interval = save_interval
+        self._saver = None
+        self._dirty = False
+        self._heap = []  # (الموعد على الساعة الرتيبة, رقم تسلسلي, group_id)
+        self._entries = {}  # group_id -> {"seq", "due", "due_wall", "interval", "align", "last_fired"}
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._runner = None
+        self._application = None
+        self._inflight = set()
+        self._waiting_until = None  # موعد انتهاء انتظار الحلقة الحالي (None أثناء المعالجة)
+
+    def __contains__(self, group_id):
+        return group_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def running(self):
+        return self._runner is not None and not self._runner.done()
+
+    def start(self, application):
+        """بدء حلقة المجدول على حلقة الأحداث الحالية"""
+        if self.running:
+            return
+        self._application = application
+        self._wakeup = asyncio.Event()
+        self._runner = asyncio.create_task(self._run())
+        if self._save is not None:
+            self._saver = asyncio.create_task(self._save_loop())
+
+    async def stop(self):
+        """إيقاف حلقة المجدول وانتظار عمليات الإرسال الجارية"""
+        if self._runner is not None:
+            self._runner.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._runner
+            self._runner = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        if self._saver is not None:
+            self._saver.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._saver
+            self._saver = None
+            await self._save_now()
+
+    def snapshot(self):
+        """حالة المواعيد القابلة للحفظ {group_id: {"last_sent", "next_due", "interval"}}"""
+        return {
+            group_id: {"last_sent": e["last_fired"], "next_due": e["due_wall"], "interval": e["interval"]}
+            for group_id, e in self._entries.items()
+        }
+
+    async def _save_now(self):
+        self._dirty = False
+        try:
+            await self._save(self.snapshot())
+        except Exception as e:
+            self._dirty = True
+            logger.error(f"خطأ في حفظ حالة المجدول: {e}")
+
+    async def _save_loop(self):
+        while True:
+            await clock.sleep(self._save_interval)
+            if self._dirty:
+                await self._save_now()
+
+    async def wait_idle(self):
+        """انتظار معالجة كل ما استحق وانتهاء عمليات الإرسال الجارية (للمحاكاة)"""
+        while self.running:
+            if self._inflight:
+                await asyncio.gather(*self._inflight, return_exceptions=True)
+            await asyncio.sleep(0)
+            if (self._waiting_until is not None and self._waiting_until > clock.monotonic()
+                    and not self._inflight and not self._wakeup.is_set()):
+                return
+
+    def next_send_at(self, group_id):
+        """الطابع الزمني (ساعة الحائط) للإرسال القادم أو None"""
+        entry = self._entries.get(group_id)
+        return entry["due_wall"] if entry else None
+
+    def _place(self, group_id, due_wall, interval, align, last_fired=None, due=None, resume_at=None):
+        """تسجيل مدخل المجموعة دون إضافته إلى الكومة؛ يرجع عنصر الكومة"""
+        if due is None:
+            # تحويل الموعد من ساعة الحائط إلى الساعة الرتيبة مرة واحدة عند الجدولة
+            due = clock.monotonic() + (due_wall - clock.time())
+        seq = next(self._seq)
+        self._entries[group_id] = {
+            "seq": seq, "due": due, "due_wall": due_wall,
+            "interval": interval, "align": align, "last_fired": last_fired,
+            "resume_at": resume_at  # الموعد التالي بعد إرسال تعويضي (للعودة إلى الطور الأصلي)
+        }
+        self._dirty = True
+        return (due, seq, group_id)
+
+    def _rebuild_heap(self):
+        self._heap = [(e["due"], e["seq"], g) for g, e in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _push(self, group_id, due_wall, interval, align, last_fired=None, due=None, resume_at=None):
+        heapq.heappush(self._heap, self._place(group_id, due_wall, interval, align, last_fired, due, resume_at))
+        # ضغط الكومة إذا تراكمت المدخلات القديمة
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._rebuild_heap()
+        self._notify()
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def add(self, group_id, interval, delay=0, align=None):
+        """إضافة مجموعة (أو استبدالها) بحيث يكون أول إرسال بعد delay ثانية
+
+        إذا كانت align رقماً فهي إزاحة بالثواني بعد حد خطوة TOTP، ويُؤجل الإرسال إلى أول حد تالٍ.
+        """
+        due_wall = clock.time() + delay
+        if align is not None:
+            due_wall = next_aligned_deadline(due_wall, align)
+        self._push(group_id, due_wall, interval, align)
+
+    def resume(self, group_id, interval, state=None, align=None,
+               catchup=SCHEDULE_CATCHUP, jitter=SCHEDULE_CATCHUP_JITTER, start_jitter=0):
+        """استئناف جدولة مجموعة بعد إعادة التشغيل مع الحفاظ على طورها المحفوظ
+
+        state: المدخل المحفوظ من snapshot(). إذا فات موعد أثناء التوقف يُرسل إرسال تعويضي
+        واحد في وقت عشوائي ضمن jitter ثانية (سياسة "once") ثم تعود المواعيد إلى طورها.
+        المجموعات بلا حالة محفوظة تبدأ في وقت عشوائي ضمن start_jitter ثانية (0 = فوراً).
+        """
+        due_wall, last_sent, resume_at = self._resume_plan(interval, state, align, catchup, jitter, start_jitter)
+        self._push(group_id, due_wall, interval, align, last_sent, resume_at=resume_at)
+
+    def resume_many(self, groups, saved_state, catchup=SCHEDULE_CATCHUP, jitter=SCHEDULE_CATCHUP_JITTER,
+                    start_jitter=0):
+        """استئناف عدة مجموعات دفعة واحدة: groups قائمة (group_id، الفاصل، المحاذاة)
+
+        تُسجل كل المدخلات ثم تُبنى الكومة مرة واحدة بـ heapify (O(n)) مع إيقاظ واحد للحلقة.
+        """
+        for group_id, interval, align in groups:
+            due_wall, last_sent, resume_at = self._resume_plan(
+                interval, saved_state.get(group_id), align, catchup, jitter, start_jitter
+            )
+            self._place(group_id, due_wall, interval, align, last_sent, resume_at=resume_at)
+        self._rebuild_heap()
+        self._notify()
+
+    @staticmethod
+    def _resume_plan(interval, state, align, catchup, jitter, start_jitter=0):
+        """حساب (الموعد الأول، آخر إرسال، موعد العودة للطور) لمجموعة مستأنفة"""
+        now = clock.time()
+        anchor = None
+        last_sent = None
+        if state:
+            last_sent = state.get("last_sent")
+            if state.get("interval") == interval and state.get("next_due") is not None:
+                anchor = state["next_due"]
+            elif last_sent is not None:
+                # تغير الفاصل أثناء التوقف: الطور الجديد يبدأ من آخر إرسال
+                anchor = last_sent + interval
+
+        if anchor is None:
+            # لا طور محفوظ: فوراً، أو موزعاً على start_jitter عند بدء التشغيل دون ملف حالة
+            due_wall = now + random.uniform(0, start_jitter) if start_jitter else now
+            if align is not None:
+                due_wall = next_aligned_deadline(due_wall, align)
+            return due_wall, None, None
+
+        if anchor >= now:
+            return (anchor if align is None else next_aligned_deadline(anchor, align)), last_sent, None
+
+        # أول موعد على نفس الطور بعد الآن
+        next_wall = anchor + math.ceil((now - anchor) / interval) * interval
+        if align is not None:
+            next_wall = next_aligned_deadline(next_wall, align)
+        catchup_at = now + random.uniform(0, jitter)
+        if catchup == "once" and catchup_at < next_wall:
+            return catchup_at, last_sent, next_wall
+        return next_wall, last_sent, None
+
+    def remove(self, group_id):
+        """إزالة مجموعة من الجدولة؛ يرجع True إذا كانت مجدولة"""
+        if self._entries.pop(group_id, None) is None:
+            return False
+        self._dirty = True
+        self._notify()
+        return True
+
+    def reschedule(self, group_id, interval, align=None):
+        """تغيير الفاصل الزمني أو المحاذاة مع الحفاظ على وقت آخر إرسال"""
+        entry = self._entries.get(group_id)
+        if entry is None or entry["last_fired"] is None:
+            self.add(group_id, interval, align=align)
+            return
+        due_wall = max(entry["last_fired"] + interval, clock.time())
+        if align is not None:
+            due_wall = next_aligned_deadline(due_wall, align)
+        self._push(group_id, due_wall, interval, align, entry["last_fired"])
+
+    @staticmethod
+    def _next_deadline(due_wall, interval, align):
+        """الموعد التالي مطلقاً بعد الموعد due_wall"""
+        next_wall = due_wall + interval
+        if align is not None:
+            next_wall = next_aligned_deadline(next_wall, align)
+        return next_wall
+
+    async def _run(self):
+        while True:
+            heap = self._heap
+            # تجاهل المدخلات القديمة (المحذوفة أو المعاد جدولتها)
+            while heap and self._entries.get(heap[0][2], {}).get("seq") != heap[0][1]:
+                heapq.heappop(heap)
+
+            if not heap:
+                timeout = None
+            else:
+                timeout = heap[0][0] - clock.monotonic()
+
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                self._waiting_until = math.inf if timeout is None else heap[0][0]
+                try:
+                    await clock.wait(self._wakeup, timeout)
+                finally:
+                    self._waiting_until = None
+                continue
+
+            due, _, group_id = heapq.heappop(heap)
+            entry = self._entries[group_id]
+            interval, align = entry["interval"], entry["align"]
+            now = clock.monotonic()
+            metrics.observe("bot_scheduler_lateness_seconds", max(0.0, now - due))
+
+            next_wall = entry["resume_at"] or self._next_deadline(entry["due_wall"], interval, align)
+            next_due = due + (next_wall - entry["due_wall"])
+            if next_due <= now:
+                # تأخر كبير (مثل توقف العملية): تخطي المواعيد الفائتة مع الحفاظ على الطور
+                missed = math.floor((now - next_due) / interval) + 1
+                skipped_wall = self._next_deadline(next_wall + (missed - 1) * interval, interval, align)
+                next_due += skipped_wall - next_wall
+                next_wall = skipped_wall
+
+            self._push(group_id, next_wall, interval, align, last_fired=entry["due_wall"], due=next_due)
+            self._fire(group_id, next_wall)
+
+    def _fire(self, group_id, next_send_at):
+        send = self._send or send_auth_message
+        task = asyncio.create_task(send(self._application.bot, group_id, next_send_at=next_send_at))
+        self._inflight.add(task)
+        task.add_done_callback(self._on_fired)
+
+    def _on_fired(self, task):
+        self._inflight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"خطأ في المهمة الدورية: {task.exception()}")
+
+
+scheduler = GroupScheduler(save=persistence.save_schedule)
+
 async def start_periodic_task(application, group_id):
     """بدء مهمة دورية لإرسال رمز المصادقة"""
-    config = load_config()
+    config = await persistence.load_config(readonly=True)
     
     if group_id not in config["groups"]:
         logger.error(f"المجموعة {group_id} غير موجودة في الإعدادات")
         return
     
-    await stop_periodic_task(application, group_id)
-    
-    stop_flags[group_id] = threading.Event()
-    
     interval = config["groups"][group_id].get("interval", 600)
     if interval <= 0: # التأكد من أن الفاصل الزمني موجب
+        scheduler.remove(group_id)
         logger.warning(f"الفاصل الزمني للمجموعة {group_id} غير موجب ({interval}). لن يتم بدء المهمة الدورية.")
         return
-        
-    thread = threading.Thread(
-        target=periodic_task_thread,
-        args=(application.bot, group_id, interval, stop_flags[group_id]),
-        daemon=True
-    )
-    thread.start()
     
-    scheduled_tasks[group_id] = thread
+    align = get_schedule_alignment(config["groups"][group_id])
+    scheduler.start(application)
+    scheduler.add(group_id, interval, align=align)
     logger.info(f"تم بدء المهمة الدورية للمجموعة {group_id} بفاصل زمني {interval} ثانية")
 
+async def start_all_periodic_tasks(application):
+    """تسجيل جميع المجموعات عند بدء التشغيل في تمريرة واحدة
+
+    تُقرأ الإعدادات وحالة المجدول مرة واحدة، وتُتحقق أسرار TOTP كلها (مع تعبئة ذاكرة
+    الرموز)، ثم تُسجل المواعيد دفعة واحدة. يُسجل زمن كل مرحلة في السجل والمقاييس.
+    """
+    timings = {}
+    started = time.perf_counter()
+    config = await persistence.load_config(readonly=True)
+    saved_state = await persistence.load_schedule()
+    # بدون ملف حالة (أول تشغيل بعد الترقية) تُوزع بدايات كل المجموعات حتى لا تُرسل دفعة واحدة
+    start_jitter = SCHEDULE_CATCHUP_JITTER if saved_state is None else 0
+    saved_state = saved_state or {}
+    timings["load"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    groups = []
+    invalid = []
+    for group_id, group_config in config["groups"].items():
+        interval = group_config.get("interval", 600)
+        if interval <= 0:
+            continue
+        try:
+            totp_engine.get_code(group_id, group_config.get("totp_secret"))
+        except Exception:
+            # تبقى مجدولة حتى تصل رسالة الخطأ المعتادة إلى المجموعة
+            invalid.append(group_id)
+        groups.append((group_id, interval, get_schedule_alignment(group_config)))
+    timings["validate"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    scheduler.start(application)
+    scheduler.resume_many(groups, saved_state, jitter=SCHEDULE_CATCHUP_JITTER, start_jitter=start_jitter)
+    timings["register"] = time.perf_counter() - started
+
+    for phase, seconds in timings.items():
+        metrics.observe("bot_startup_seconds", seconds, phase=phase)
+    if invalid:
+        logger.warning(f"أسرار TOTP غير صالحة لـ {len(invalid)} مجموعة: {', '.join(invalid[:10])}")
+    logger.info(
+        f"تم بدء {len(groups)} مهمة دورية من {len(config['groups'])} مجموعة "
+        f"(تحميل {timings['load']:.3f}ث، تحقق {timings['validate']:.3f}ث، جدولة {timings['register']:.3f}ث)"
+    )
+
 async def stop_periodic_task(application, group_id):
     """إيقاف مهمة دورية لإرسال رمز المصادقة"""
-    if group_id in stop_flags:
-        stop_flags[group_id].set()
-        if group_id in scheduled_tasks:
-            scheduled_tasks[group_id].join(timeout=1) # إضافة مهلة للانتظار
-            del scheduled_tasks[group_id]
-        del stop_flags[group_id]
+    if scheduler.remove(group_id):
         logger.info(f"تم إيقاف المهمة الدورية للمجموعة {group_id}")
 
-def periodic_task_thread(bot, group_id, interval, stop_flag):
-    """خيط للمهمة الدورية"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    
-    while not stop_flag.is_set():
-        try:
-            loop.run_until_complete(send_auth_message(bot, group_id))
-        except Exception as e:
-            logger.error(f"خطأ في خيط المهمة الدورية للمجموعة {group_id}: {e}")
-            # يمكنك إضافة منطق لإعادة المحاولة أو إيقاف المهمة إذا تكررت الأخطاء
-            
-        # انتظار الفاصل الزمني أو حتى يتم تعيين علم الإيقاف
-        # استخدام time.sleep() في خيط منفصل مقبول
-        # لكن تأكد من أن الانتظار لا يمنع الإيقاف السريع
-        wait_interval = 1 # تحقق كل ثانية
-        for _ in range(interval):
-            if stop_flag.is_set():
-                break
-            time.sleep(wait_interval)
-            
-    loop.close()
-    logger.info(f"تم إنهاء خيط المهمة الدورية للمجموعة {group_id}")
+async def reschedule_periodic_task(application, group_id):
+    """تطبيق فاصل زمني جديد لمجموعة مع الحفاظ على وقت آخر إرسال"""
+    config = await persistence.load_config(readonly=True)
+    group_config = config["groups"].get(group_id, {})
+    interval = group_config.get("interval", 600)
+    if interval <= 0:
+        await stop_periodic_task(application, group_id)
+        return
+    scheduler.start(application)
+    scheduler.reschedule(group_id, interval, align=get_schedule_alignment(group_config))
+    logger.info(f"تمت إعادة جدولة المجموعة {group_id} بفاصل زمني {interval} ثانية")
+
+class ConfigReloader:
+    """مراقبة config.json وتطبيق الفروقات على المجدول للمجموعات المتأثرة فقط
+
+    يحتفظ بنسخة من إعدادات المجموعات المطبقة، وعند تغير الملف (أو بعد حفظه من لوحة الإدارة)
+    يقارنها بالإعدادات الجديدة: المجموعات المضافة تُجدول، والمحذوفة تُزال، وتغيير الفاصل أو
+    المحاذاة يعيد جدولة المجموعة مع الحفاظ على آخر إرسال. الشكل والمنطقة الزمنية يُقرآن عند
+    كل إرسال فلا يحتاجان أي إجراء. لا تُلغى عمليات الإرسال الجارية.
+    """
+
+    SCHEDULE_FIELDS = ("interval", "align_to_totp", "send_offset")
+
+    def __init__(self, interval=CONFIG_RELOAD_INTERVAL):
+        self.interval = interval
+        self._groups = None
+        self._version = None
+        self._application = None
+        self._runner = None
+        self._lock = asyncio.Lock()
+        self._failed_signature = None
+
+    def start(self, application):
+        """تسجيل الإعدادات الحالية كنقطة مرجعية وبدء مراقبة الملف"""
+        self._application = application
+        self._groups = copy.deepcopy(load_config(readonly=True)["groups"])
+        self._version = get_config_version()
+        if self.interval > 0 and (self._runner is None or self._runner.done()):
+            self._runner = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._runner
+            self._runner = None
+
+    async def _run(self):
+        while True:
+            await clock.sleep(self.interval)
+            try:
+                await self.reconcile()
+                self._failed_signature = None
+            except Exception as e:
+                # غالباً ملف محفوظ جزئياً؛ تُعاد المحاولة في الدورة التالية (مع تحذير واحد لكل نسخة)
+                signature = _file_signature(CONFIG_FILE)
+                if signature != self._failed_signature:
+                    self._failed_signature = signature
+                    logger.warning(f"تعذر إعادة تحميل الإعدادات: {e}")
+
+    @classmethod
+    def diff_groups(cls, old, new):
+        """إرجاع (المضافة، المحذوفة، {group_id: الحقول المتغيرة})"""
+        added = [g for g in new if g not in old]
+        removed = [g for g in old if g not in new]
+        changed = {}
+        for group_id in new:
+            if group_id in old and old[group_id] != new[group_id]:
+                fields = {k for k in set(old[group_id]) | set(new[group_id])
+                          if old[group_id].get(k) != new[group_id].get(k)}
+                changed[group_id] = fields
+        return added, removed, changed
+
+    async def reconcile(self, application=None):
+        """مقارنة الإعدادات الحالية بآخر نسخة مطبقة وتطبيق الفرق فقط"""
+        async with self._lock:
+            application = application or self._application
+            config = await persistence.load_config(readonly=True)
+            if self._groups is not None and get_config_version() == self._version:
+                return
+            new_groups = config["groups"]
+            added, removed, changed = self.diff_groups(self._groups or {}, new_groups)
+
+            for group_id in removed:
+                await stop_periodic_task(application, group_id)
+                totp_engine.invalidate(group_id)
+                group_breakers.reset(group_id)
+            for group_id in added:
+                if group_id not in scheduler and new_groups[group_id].get("interval", 600) > 0:
+                    await start_periodic_task(application, group_id)
+            for group_id, fields in changed.items():
+                if "totp_secret" in fields:
+                    totp_engine.invalidate(group_id)
+                if fields.intersection(self.SCHEDULE_FIELDS):
+                    await reschedule_periodic_task(application, group_id)
+
+            self._groups = copy.deepcopy(new_groups)
+            self._version = get_config_version()
+            if added or removed or changed:
+                logger.info(
+                    f"تم تطبيق تغييرات الإعدادات: {len(added)} مضافة، {len(removed)} محذوفة، {len(changed)} معدلة"
+                )
+
+
+config_reloader = ConfigReloader()
+
+class CircuitBreaker:
+    """قاطع دائرة لكل مجموعة يوقف الإرسال مؤقتاً بعد أخطاء دائمة متتالية
+
+    بعد threshold أخطاء دائمة (طرد البوت، محادثة غير موجودة أو تمت ترقيتها) تُفتح الدائرة
+    ويُتجاهل الإرسال حتى انتهاء مدة الانتظار، ثم يُسمح بمحاولة اختبار واحدة (half-open):
+    نجاحها يغلق الدائرة، وفشلها يعيد فتحها بضعف مدة الانتظار حتى max_backoff.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    PERMANENT_MESSAGES = (
+        "chat not found", "group chat was upgraded", "bot was kicked", "bot is not a member",
+        "not enough rights", "have no rights", "chat_write_forbidden"
+    )
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, base_backoff=BREAKER_BASE_BACKOFF,
+                 max_backoff=BREAKER_MAX_BACKOFF):
+        self.threshold = threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._groups = {}  # group_id -> {"state", "failures", "backoff", "retry_at", "last_error"}
+
+    @classmethod
+    def is_permanent(cls, error):
+        """هل الخطأ دائم (لن ينجح الإرسال بإعادة المحاولة)؟"""
+        if isinstance(error, (Forbidden, ChatMigrated)):
+            return True
+        if isinstance(error, BadRequest):
+            message = str(error).lower()
+            return any(text in message for text in cls.PERMANENT_MESSAGES)
+        return False
+
+    def allow(self, group_id):
+        """هل يُسمح بالإرسال الآن؟ (تتحول الدائرة المفتوحة إلى half-open عند حلول موعد الاختبار)"""
+        entry = self._groups.get(group_id)
+        if entry is None or entry["state"] == self.CLOSED:
+            return True
+        now = clock.time()
+        if now >= entry["retry_at"]:
+            # محاولة اختبار واحدة؛ إذا انتهت دون نتيجة حاسمة (خطأ مؤقت، تخطٍ) يُسمح بغيرها بعد نفس المدة
+            entry["state"] = self.HALF_OPEN
+            entry["retry_at"] = now + entry["backoff"]
+            return True
+        return False
+
+    def record_success(self, group_id):
+        entry = self._groups.pop(group_id, None)
+        if entry is not None and entry["state"] != self.CLOSED:
+            logger.info(f"عاد الإرسال إلى المجموعة {group_id} بعد إيقاف مؤقت")
 
-async def send_auth_message(bot, group_id):
-    """إرسال رسالة المصادقة إلى المجموعة"""
-    config = load_config()
+    def record_failure(self, group_id, error):
+        """تسجيل فشل الإرسال؛ الأخطاء المؤقتة لا تُحتسب"""
+        if not self.is_permanent(error):
+            entry = self._groups.get(group_id)
+            if entry is not None and entry["state"] == self.HALF_OPEN:
+                # فشل الاختبار لسبب مؤقت: العودة إلى الإيقاف حتى موعد الاختبار التالي
+                entry["state"] = self.OPEN
+            return
+        entry = self._groups.setdefault(
+            group_id, {"state": self.CLOSED, "failures": 0, "backoff": 0, "retry_at": None, "last_error": None}
+        )
+        entry["failures"] += 1
+        entry["last_error"] = str(error)
+        if entry["state"] == self.HALF_OPEN:
+            entry["backoff"] = min(entry["backoff"] * 2, self.max_backoff)
+        elif entry["state"] == self.CLOSED and entry["failures"] >= self.threshold:
+            entry["backoff"] = self.base_backoff
+        else:
+            return
+        entry["state"] = self.OPEN
+        entry["retry_at"] = clock.time() + entry["backoff"]
+        logger.warning(
+            f"تم إيقاف الإرسال إلى المجموعة {group_id} مؤقتاً بعد {entry['failures']} فشل متتالٍ "
+            f"({entry['last_error']})، المحاولة التالية بعد {int(entry['backoff'])} ثانية"
+        )
+
+    def reset(self, group_id):
+        """إغلاق الدائرة يدوياً (من لوحة الإدارة) أو نسيان مجموعة محذوفة"""
+        return self._groups.pop(group_id, None) is not None
+
+    def open_groups(self):
+        """المجموعات الموقوفة مؤقتاً {group_id: الحالة}"""
+        return {g: dict(e) for g, e in self._groups.items() if e["state"] != self.CLOSED}
+
+
+group_breakers = CircuitBreaker()
+
+async def send_auth_message(bot, group_id, next_send_at=None):
+    """إرسال رسالة المصادقة إلى المجموعة (next_send_at: موعد الإرسال التالي المجدول)"""
+    started = time.perf_counter()
+    result = "error"  # استثناء لم يُعالج
+    try:
+        result = await _send_auth_message(bot, group_id, next_send_at)
+    finally:
+        metrics.inc("bot_auth_messages_total", group=group_id, result=result)
+        metrics.observe("bot_send_auth_message_seconds", time.perf_counter() - started, group=group_id)
+
+async def _send_auth_message(bot, group_id, next_send_at):
+    """تنفيذ الإرسال وإرجاع نتيجته للمقاييس"""
+    config = await persistence.load_config(readonly=True)
     
     if group_id not in config["groups"]:
         logger.error(f"المجموعة {group_id} غير موجودة في الإعدادات عند محاولة إرسال الرسالة")
-        return
+        return "skipped"
     
     group_config = config["groups"][group_id]
     totp_secret = group_config.get("totp_secret")
@@ -1098,32 +3279,36 @@ async def send_auth_message(bot, group_id):
     
     if not totp_secret:
         logger.error(f"TOTP_SECRET غير موجود للمجموعة {group_id}")
-        return
+        return "skipped"
         
     if interval <= 0:
         # لا ترسل رسائل إذا كان التكرار متوقفاً (interval=0 أو سالب)
-        return
+        return "skipped"
+    
+    if not group_breakers.allow(group_id):
+        # المجموعة غير قابلة للوصول حالياً (قاطع الدائرة مفتوح)
+        return "suppressed"
         
     try:
-        totp = pyotp.TOTP(totp_secret)
-        code = totp.now()
-        remaining_validity = get_remaining_validity(totp)
+        code, remaining_validity = totp_engine.get_code(group_id, totp_secret)
     except Exception as e:
         logger.error(f"خطأ في توليد رمز TOTP للمجموعة {group_id}: {e}")
         # إرسال رسالة خطأ للمجموعة؟ أو فقط تسجيل الخطأ؟
         try:
-            await bot.send_message(
+            await outbox.send(
+                OutboundQueue.LANE_BROADCAST, bot.send_message,
                 chat_id=int(group_id),
                 text=f"⚠️ خطأ في توليد رمز المصادقة للمجموعة {group_id}. يرجى مراجعة TOTP_SECRET."
             )
         except Exception as send_error:
+            group_breakers.record_failure(group_id, send_error)
             logger.error(f"خطأ في إرسال رسالة خطأ TOTP إلى المجموعة {group_id}: {send_error}")
-        return
+        return "totp_error"
 
     
     # تحضير الرسالة حسب النمط المختار
     current_time = get_time_format(timezone_name)
-    next_time = get_next_time(interval, timezone_name)
+    next_time = get_next_time(interval, timezone_name, next_send_at)
     interval_text = format_interval(interval)
     
     if message_style == 1:
@@ -1139,93 +3324,380 @@ async def send_auth_message(bot, group_id):
     
     try:
         # إرسال الرسالة إلى المجموعة
-        await bot.send_message(
+        await outbox.send(
+            OutboundQueue.LANE_BROADCAST, bot.send_message,
             chat_id=int(group_id),
             text=message,
             reply_markup=reply_markup
         )
+        group_breakers.record_success(group_id)
         logger.info(f"تم إرسال رسالة المصادقة إلى المجموعة {group_id}")
+        return "sent"
     except Exception as e:
+        group_breakers.record_failure(group_id, e)
         logger.error(f"خطأ في إرسال رسالة المصادقة إلى المجموعة {group_id}: {str(e)}")
+        return "failed"
 
 # وظائف معالجة الأزرار
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة النقر على الأزرار"""
     query = update.callback_query
-    await query.answer()
     
     if query.data.startswith("copy_code_"):
-        # معالجة زر Copy Code
+        # معالجة زر Copy Code (يُجاب على النقرة مرة واحدة لاحقاً مع التنبيه المناسب)
         group_id = query.data.replace("copy_code_", "")
         await handle_copy_code(update, context, group_id)
     else:
         # معالجة الأزرار الأخرى (يتم التعامل معها في المحادثة)
-        pass
+        await query.answer()
+
+class UnreachableUsers:
+    """ذاكرة مؤقتة (TTL) للمستخدمين الذين رفض تيليجرام مراسلتهم خاصة
+
+    تُملأ من أخطاء Forbidden وتُمسح عند /start، فتُرفض نقراتهم التالية فوراً دون خصم
+    محاولة أو كتابة على القرص أو استدعاء API. الحجم محدود مع إزالة الأقدم أولاً.
+    """
+
+    def __init__(self, ttl=DM_UNREACHABLE_TTL, max_size=DM_UNREACHABLE_MAX):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires = collections.OrderedDict()  # user_id -> وقت الانتهاء (clock.monotonic)
+
+    def add(self, user_id):
+        if self.ttl <= 0:
+            return
+        user_id = str(user_id)
+        self._expires.pop(user_id, None)
+        self._expires[user_id] = clock.monotonic() + self.ttl
+        while len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+
+    def discard(self, user_id):
+        self._expires.pop(str(user_id), None)
+
+    def __contains__(self, user_id):
+        user_id = str(user_id)
+        expires = self._expires.get(user_id)
+        if expires is None:
+            return False
+        if clock.monotonic() >= expires:
+            del self._expires[user_id]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._expires)
+
+
+dm_unreachable = UnreachableUsers()
+
+DM_UNREACHABLE_ALERT = "لم نتمكن من إرسال رسالة خاصة. ⚠️ يرجى التأكد من أنك بدأت محادثة مع البوت ولم تقم بحظره."
+
+
+class ClickThrottle:
+    """حد معدل نقرات Copy Code لكل (مستخدم، مجموعة) في الذاكرة قبل أي تخزين أو استدعاء API
+
+    دلو رموز لكل مفتاح في OrderedDict مع إزالة الأقل استخداماً (LRU) عند تجاوز max_keys،
+    لذا الفحص O(1). يتذكر أيضاً آخر يوم أُرسل فيه إشعار استنفاد المحاولات حتى لا يتكرر.
+    """
+
+    def __init__(self, rate=CLICK_THROTTLE_RATE, burst=CLICK_THROTTLE_BURST, max_keys=CLICK_THROTTLE_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._entries = collections.OrderedDict()  # (user_id, group_id) -> [TokenBucket, يوم آخر إشعار استنفاد]
+
+    def _entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [TokenBucket(self.rate, self.burst, now=clock.monotonic()), None]
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    def allow(self, user_id, group_id):
+        """هل تُعالج هذه النقرة؟ (False = نقرات أسرع من المسموح)"""
+        if self.rate <= 0:
+            return True
+        return self._entry((user_id, group_id))[0].try_take(clock.monotonic())
+
+    def notify_exhausted(self, user_id, group_id, today):
+        """هل يُرسل إشعار الاستنفاد؟ مرة واحدة فقط لكل (مستخدم، مجموعة) في اليوم"""
+        entry = self._entry((user_id, group_id))
+        if entry[1] == today:
+            return False
+        entry[1] = today
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+click_throttle = ClickThrottle()
+
+class SlidingWindowCounters:
+    """عدادات نافذة منزلقة بذاكرة ثابتة لكل مفتاح
+
+    لكل مفتاح ثلاث قيم فقط: رقم النافذة الحالية وعددها وعدد النافذة السابقة، ويُقدر العدد
+    خلال آخر window ثانية بـ current + previous * (الجزء غير المنقضي من النافذة الحالية).
+    الفحص والتحديث O(1) مهما طال السجل. مع sliding=False تصبح نافذة ثابتة (مثل خطوة TOTP).
+    """
+
+    def __init__(self, sliding=True, max_keys=QUOTA_COUNTERS_MAX):
+        self.sliding = sliding
+        self.max_keys = max_keys
+        self._entries = collections.OrderedDict()  # المفتاح -> [رقم النافذة، العدد الحالي، العدد السابق]
+
+    def _entry(self, key, window, now):
+        index = int(now // window)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [index, 0, 0]
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+            if entry[0] != index:
+                entry[2] = entry[1] if entry[0] == index - 1 else 0
+                entry[1] = 0
+                entry[0] = index
+        return entry
+
+    def count(self, key, window, now):
+        """العدد التقديري خلال آخر window ثانية"""
+        entry = self._entry(key, window, now)
+        if not self.sliding:
+            return entry[1]
+        return entry[1] + entry[2] * (1 - (now % window) / window)
+
+    def try_add(self, key, limit, window, now):
+        """زيادة العداد إذا بقي ضمن limit؛ يرجع True عند النجاح"""
+        if self.count(key, window, now) + 1 > limit:
+            return False
+        self._entries[key][1] += 1
+        return True
+
+    def remove(self, key, window, now):
+        """التراجع عن زيادة سابقة في نفس النافذة"""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == int(now // window) and entry[1] > 0:
+            entry[1] -= 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CopyCodeQuotas:
+    """حصص النافذة المنزلقة وخطوة TOTP في الذاكرة (الحصة اليومية في واجهة التخزين)
+
+    acquire() يحجز من الحصص قبل خصم المحاولة، وrelease() يعيد الحجز إذا لم يُرسل الرمز،
+    بنفس نمط consume_attempt/refund_attempt.
+    """
+
+    def __init__(self):
+        self.rolling = SlidingWindowCounters()
+        self.per_step = SlidingWindowCounters(sliding=False)
+
+    def acquire(self, user_id, group_id, policy):
+        """يرجع None عند النجاح أو سبب الرفض ("per_step" أو "rolling")"""
+        now = clock.time()
+        if policy["per_step"] and not self.per_step.try_add(group_id, policy["per_step"], TOTP_STEP, now):
+            return "per_step"
+        if policy["rolling_limit"] and policy["rolling_hours"]:
+            window = policy["rolling_hours"] * 3600
+            if not self.rolling.try_add((user_id, group_id), policy["rolling_limit"], window, now):
+                if policy["per_step"]:
+                    self.per_step.remove(group_id, TOTP_STEP, now)
+                return "rolling"
+        return None
+
+    def release(self, user_id, group_id, policy):
+        now = clock.time()
+        if policy["per_step"]:
+            self.per_step.remove(group_id, TOTP_STEP, now)
+        if policy["rolling_limit"] and policy["rolling_hours"]:
+            self.rolling.remove((user_id, group_id), policy["rolling_hours"] * 3600, now)
+
+    def __len__(self):
+        return len(self.rolling) + len(self.per_step)
+
+
+copy_code_quotas = CopyCodeQuotas()
+
+CLICK_THROTTLED_ALERT = "⏳ أنت تضغط بسرعة كبيرة! يرجى الانتظار بضع ثوانٍ ثم المحاولة مجدداً."
+
+
+class CallbackDeduper:
+    """منع تكرار معالجة نقرات Copy Code المكررة (نقر مزدوج أو إعادة تسليم من تيليجرام)
+
+    تُسجل كل نقرة قيد المعالجة بمفتاحين: query id و(المستخدم، المجموعة، خطوة TOTP).
+    النقرة المكررة تنتظر نتيجة الأولى وتعيد نفس التنبيه دون خصم أو كتابة أو رسالة جديدة.
+    يبقى مفتاح query id لمدة window ثانية، ومفتاح الخطوة فقط بعد النجاح (الرمز نفسه أُرسل مسبقاً).
+    """
+
+    def __init__(self, window=CALLBACK_DEDUPE_WINDOW):
+        self.window = window
+        self._entries = collections.OrderedDict()  # المفتاح -> (وقت الانتهاء، future للنتيجة)
+
+    def _prune(self, now):
+        while self._entries:
+            key, (expires, future) = next(iter(self._entries.items()))
+            if expires > now or not future.done():
+                break
+            del self._entries[key]
+
+    def lookup(self, query_id, step_key):
+        """future نتيجة النقرة الأصلية إذا كانت هذه نقرة مكررة، وإلا None"""
+        if self.window <= 0:
+            return None
+        now = clock.monotonic()
+        self._prune(now)
+        for key in (("query", query_id), ("step", step_key)):
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] > now or not entry[1].done()):
+                return asyncio.shield(entry[1])
+        return None
+
+    def begin(self, query_id, step_key):
+        """تسجيل نقرة جديدة قيد المعالجة"""
+        future = asyncio.get_running_loop().create_future()
+        if self.window > 0:
+            expires = clock.monotonic() + self.window
+            for key in (("query", query_id), ("step", step_key)):
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, future)
+        return future
+
+    def finish(self, query_id, step_key, future, result, keep_step):
+        """نشر النتيجة للنقرات المنتظرة؛ مفتاح الخطوة يُحذف إذا لم تنجح النقرة"""
+        if not future.done():
+            future.set_result(result)
+        entry = self._entries.get(("step", step_key))
+        if not keep_step and entry is not None and entry[1] is future:
+            del self._entries[("step", step_key)]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+copy_code_deduper = CallbackDeduper()
 
 async def handle_copy_code(update: Update, context: ContextTypes.DEFAULT_TYPE, group_id):
     """معالجة زر Copy Code"""
+    started = time.perf_counter()
+    outcome = "error"  # استثناء لم يُعالج (مثلاً فشل query.answer)
+    try:
+        outcome = await _handle_copy_code(update, context, group_id)
+    finally:
+        metrics.inc("bot_copy_code_total", outcome=outcome)
+        metrics.observe("bot_copy_code_seconds", time.perf_counter() - started, outcome=outcome)
+
+async def _handle_copy_code(update, context, group_id):
+    """تنفيذ النسخ وإرجاع النتيجة للمقاييس"""
     query = update.callback_query
     user_id = str(query.from_user.id)
     
-    config = load_config()
-    users = load_users()
+    # النقرة المكررة (نفس query id أو نفس المستخدم والمجموعة وخطوة TOTP) تعيد نتيجة الأولى
+    step_key = (user_id, group_id, int(clock.time() // TOTP_STEP))
+    shared = copy_code_deduper.lookup(query.id, step_key)
+    if shared is not None:
+        # إجابة هذه النقرة بنفس تنبيه الأولى (مرة واحدة، حتى لو لم يكن للأولى تنبيه)
+        _, alert = await shared
+        await query.answer(alert, show_alert=bool(alert))
+        return "duplicate"
+    
+    future = copy_code_deduper.begin(query.id, step_key)
+    outcome, alert = "failed", None
+    try:
+        outcome, alert = await _copy_code(query, context, user_id, group_id)
+    finally:
+        copy_code_deduper.finish(query.id, step_key, future, (outcome, alert), keep_step=outcome == "success")
+    # الإجابة الوحيدة على النقرة (تيليجرام يرفض الإجابة الثانية)
+    await query.answer(alert, show_alert=bool(alert))
+    return outcome
+
+async def _copy_code(query, context, user_id, group_id):
+    """خصم المحاولة وإرسال الرمز خاصة؛ يرجع (النتيجة، نص التنبيه)"""
+    if not click_throttle.allow(user_id, group_id):
+        # نقرات متكررة: رد فوري دون تحميل الإعدادات أو المستخدمين
+        return "throttled", CLICK_THROTTLED_ALERT
+    
+    config = await persistence.load_config(readonly=True)
     
     if group_id not in config["groups"]:
         # قد تكون الرسالة قديمة والمجموعة حذفت
         await query.edit_message_reply_markup(reply_markup=None) # إزالة الزر
-        await query.answer("خطأ: المجموعة لم تعد موجودة. 🤷‍♂️", show_alert=True)
-        return
-    
-    if user_id in users and users[user_id].get("banned", False):
-        await query.answer("أنت محظور من استخدام هذا البوت. 🚫", show_alert=True)
-        return
-    
-    today = datetime.datetime.now().strftime("%Y-%m-%d")
-    
-    if user_id not in users:
-        users[user_id] = {"attempts": {}, "banned": False}
-    if "attempts" not in users[user_id]:
-        users[user_id]["attempts"] = {}
-    if group_id not in users[user_id]["attempts"]:
-        # تعيين المحاولات الافتراضية (5)
-        users[user_id]["attempts"][group_id] = {"remaining": 5, "reset_date": today}
+        return "unknown_group", "خطأ: المجموعة لم تعد موجودة. 🤷‍♂️"
     
-    # إعادة تعيين المحاولات إذا كان اليوم مختلفاً
-    if users[user_id]["attempts"][group_id]["reset_date"] != today:
-        users[user_id]["attempts"][group_id] = {"remaining": 5, "reset_date": today}
+    if user_id in dm_unreachable:
+        # فشلت مراسلة المستخدم مؤخراً ولم يرسل /start بعدها: لا خصم ولا كتابة ولا استدعاء API
+        return "dm_unreachable", DM_UNREACHABLE_ALERT
     
-    if users[user_id]["attempts"][group_id]["remaining"] <= 0:
-        await query.answer(
-            "⚠️ لقد استنفدت جميع محاولاتك لهذا اليوم! يرجى الانتظار حتى منتصف الليل لإعادة تعيين المحاولات.",
-            show_alert=True
-        )
+    group_config = config["groups"][group_id]
+    policy = get_quota_policy(group_config)
+    
+    # قفل خاص بالمستخدم طوال دورة الخصم/الإرسال/الاستعادة حتى لا تتداخل نقراته المتزامنة
+    async with user_locks(user_id):
+        limited = copy_code_quotas.acquire(user_id, group_id, policy)
+        if limited == "per_step":
+            return "quota_step", (
+                f"⏳ تم الوصول إلى الحد الأقصى لطلبات هذا الرمز. يرجى انتظار الرمز التالي "
+                f"خلال {get_remaining_validity(None)} ثانية."
+            )
+        if limited == "rolling":
+            return "quota_rolling", (
+                f"⚠️ لقد وصلت إلى الحد الأقصى ({policy['rolling_limit']} رموز كل "
+                f"{policy['rolling_hours']} ساعة). يرجى المحاولة لاحقاً."
+            )
+        
+        outcome = None
+        try:
+            outcome, alert = await _consume_and_send(query, context, user_id, group_id, group_config, policy)
+        finally:
+            if outcome != "success":
+                # لم يُرسل الرمز: إعادة الحجز من حصص الذاكرة
+                copy_code_quotas.release(user_id, group_id, policy)
+        return outcome, alert
+
+async def _consume_and_send(query, context, user_id, group_id, group_config, policy):
+    """خصم المحاولة اليومية وإرسال الرمز خاصة (يُستدعى مع قفل المستخدم)"""
+    store = get_async_store()
+    today = group_today(group_config)
+    
+    # خصم المحاولة (مع إعادة التعيين اليومية بتوقيت المجموعة) في معاملة واحدة
+    status, remaining_attempts = await store.consume_attempt(user_id, group_id, today, policy["daily"])
+    
+    if status == "banned":
+        return "banned", "أنت محظور من استخدام هذا البوت. 🚫"
+    
+    if status == "exhausted":
+        exhausted_alert = "⚠️ لقد استنفدت جميع محاولاتك لهذا اليوم! يرجى الانتظار حتى منتصف الليل لإعادة تعيين المحاولات."
+        if not click_throttle.notify_exhausted(user_id, group_id, today):
+            # تم إشعاره اليوم مسبقاً
+            return "exhausted", exhausted_alert
         # إشعار المستخدم برسالة خاصة بانتهاء المحاولات
         try:
-            await context.bot.send_message(
+            await outbox.send(
+                OutboundQueue.LANE_DM, context.bot.send_message,
                 chat_id=query.from_user.id,
                 text=f"⚠️ لقد استنفدت محاولاتك لنسخ الرمز من المجموعة {group_id} لهذا اليوم. سيتم إعادة تعيينها غداً."
             )
         except Exception as e:
+            if isinstance(e, Forbidden):
+                dm_unreachable.add(user_id)
             logger.warning(f"لم نتمكن من إرسال إشعار انتهاء المحاولات للمستخدم {user_id}: {e}")
-        return
-    
-    users[user_id]["attempts"][group_id]["remaining"] -= 1
-    save_users(users)
+        return "exhausted", exhausted_alert
     
-    totp_secret = config["groups"][group_id]["totp_secret"]
+    totp_secret = group_config["totp_secret"]
     try:
-        totp = pyotp.TOTP(totp_secret)
-        code = totp.now()
-        remaining_validity = get_remaining_validity(totp)
+        code, remaining_validity = totp_engine.get_code(group_id, totp_secret)
     except Exception as e:
         logger.error(f"خطأ في توليد رمز TOTP عند النسخ للمجموعة {group_id}: {e}")
-        await query.answer("حدث خطأ أثناء توليد الرمز. 🤯", show_alert=True)
         # إعادة المحاولة للمستخدم؟
-        users[user_id]["attempts"][group_id]["remaining"] += 1 # استعادة المحاولة
-        save_users(users)
-        return
-        
-    remaining_attempts = users[user_id]["attempts"][group_id]["remaining"]
+        await store.refund_attempt(user_id, group_id) # استعادة المحاولة
+        return "totp_error", "حدث خطأ أثناء توليد الرمز. 🤯"
     
     message = (
         f"🔐 رمز المصادقة الثنائية: `{code}`\n\n"
@@ -1234,35 +3706,414 @@ async def handle_copy_code(update: Update, context: ContextTypes.DEFAULT_TYPE, g
     )
     
     try:
-        await context.bot.send_message(
+        await outbox.send(
+            OutboundQueue.LANE_DM, context.bot.send_message,
             chat_id=query.from_user.id,
             text=message,
             parse_mode="Markdown"
         )
         # إشعار المستخدم في الـ alert بوصول الرسالة الخاصة
-        await query.answer("✅ تم إرسال رمز المصادقة إلى رسائلك الخاصة!", show_alert=True)
+        return "success", "✅ تم إرسال رمز المصادقة إلى رسائلك الخاصة!"
     except Exception as e:
+        if isinstance(e, Forbidden):
+            dm_unreachable.add(user_id)
         logger.error(f"خطأ في إرسال رمز المصادقة إلى المستخدم {user_id}: {str(e)}")
-        await query.answer(
-            "لم نتمكن من إرسال رسالة خاصة. ⚠️ يرجى التأكد من أنك بدأت محادثة مع البوت ولم تقم بحظره.",
-            show_alert=True
-        )
         # إعادة المحاولة للمستخدم؟
-        users[user_id]["attempts"][group_id]["remaining"] += 1 # استعادة المحاولة
-        save_users(users)
+        await store.refund_attempt(user_id, group_id) # استعادة المحاولة
+        return "dm_failed", DM_UNREACHABLE_ALERT
+
+# المعالجة المتزامنة للتحديثات
+class PriorityGate:
+    """عدد محدود من الفتحات يُمنح للمنتظرين حسب الأولوية (الأصغر أولاً) ثم حسب ترتيب الوصول"""
+
+    def __init__(self, slots):
+        self._free = slots
+        self._waiters = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # مُنحت الفتحة لحظة الإلغاء: إعادتها
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._free += 1
+
+
+class PrioritizedUpdateProcessor(BaseUpdateProcessor):
+    """معالجة التحديثات بالتوازي مع عدد محدود من العمال وفئات أولوية
+
+    نقرات Copy Code أولاً، ثم محادثة لوحة الإدارة، ثم /start. تحديثات المحادثة الواحدة
+    (عدا Copy Code) تُعالج بترتيب وصولها لأن حالات ConversationHandler تعتمد على ذلك.
+    """
+
+    PRIORITY_COPY_CODE = 0
+    PRIORITY_ADMIN = 1
+    PRIORITY_START = 2
+
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=UPDATE_MAX_PENDING):
+        # حد الفئة الأساسية يقيد التحديثات المعلقة، وعدد العمال الفعلي تحدده PriorityGate
+        super().__init__(max_concurrent_updates=max_pending)
+        self._gate = PriorityGate(workers)
+        self._chat_locks = {}  # chat_id -> [asyncio.Lock, عدد المستخدمين]
+
+    @classmethod
+    def classify(cls, update):
+        """تحديد أولوية التحديث"""
+        if isinstance(update, Update):
+            query = update.callback_query
+            if query is not None and (query.data or "").startswith("copy_code_"):
+                return cls.PRIORITY_COPY_CODE
+            message = update.message
+            if message is not None and (message.text or "").startswith("/start"):
+                return cls.PRIORITY_START
+        return cls.PRIORITY_ADMIN
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        priority = self.classify(update)
+        chat_key = None if priority == self.PRIORITY_COPY_CODE else self._chat_key(update)
+        if chat_key is None:
+            await self._run(priority, coroutine)
+            return
+
+        entry = self._chat_locks.get(chat_key)
+        if entry is None:
+            entry = self._chat_locks[chat_key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(priority, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_key]
+
+    async def _run(self, priority, coroutine):
+        await self._gate.acquire(priority)
+        try:
+            await coroutine
+        finally:
+            self._gate.release()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# خادم HTTP مدمج (لوضع Webhook)
+class MiniHttpServer:
+    """خادم HTTP/1.1 بسيط مبني على asyncio يدعم keep-alive وحداً أقصى للاتصالات
+
+    handler(method, path, headers, body) يرجع (رمز الحالة، نوع المحتوى، المحتوى بالبايت).
+    """
+
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error",
+               503: "Service Unavailable"}
+
+    def __init__(self, handler, host="127.0.0.1", port=8080, max_connections=100,
+                 max_body=1024 * 1024, idle_timeout=75):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.max_body = max_body
+        self.idle_timeout = idle_timeout
+        self._server = None
+        self._connections = {}  # المهمة -> writer
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        # المنفذ الفعلي (مفيد عند استخدام المنفذ 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # إغلاق الاتصالات المفتوحة لتنتهي حلقات القراءة بنهاية الملف
+            for writer in list(self._connections.values()):
+                writer.close()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    def _write_response(self, writer, status, content_type, body, keep_alive):
+        writer.write(
+            f"HTTP/1.1 {status} {self.REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + body
+        )
+
+    async def _serve(self, reader, writer):
+        task = asyncio.current_task()
+        if len(self._connections) >= self.max_connections:
+            self._write_response(writer, 503, "text/plain", b"too many connections", False)
+            await writer.drain()
+            writer.close()
+            return
+        self._connections[task] = writer
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not request_line:
+                    break
+                method, target, version = request_line.decode("latin-1").strip().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > self.max_body:
+                    self._write_response(writer, 413, "text/plain", b"payload too large", False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                try:
+                    status, content_type, payload = await self.handler(method, target, headers, body)
+                except Exception as e:
+                    logger.error(f"خطأ في معالجة طلب HTTP {method} {target}: {e}")
+                    status, content_type, payload = 500, "text/plain", b"internal error"
+                self._write_response(writer, status, content_type, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(task, None)
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+
+def make_webhook_handler(application, path, secret_token=None):
+    """معالج HTTP يستقبل تحديثات تيليجرام على المسار السري ويضعها في طابور التطبيق"""
+    async def handler(method, target, headers, body):
+        if target.split("?", 1)[0] != path:
+            return 404, "text/plain", b"not found"
+        if method != "POST":
+            return 405, "text/plain", b"method not allowed"
+        if secret_token and headers.get("x-telegram-bot-api-secret-token") != secret_token:
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except Exception as e:
+            logger.warning(f"تم رفض تحديث Webhook غير صالح: {e}")
+            return 400, "text/plain", b"bad update"
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+    return handler
+
+def make_metrics_handler(registry):
+    """معالج HTTP يعرض المقاييس على المسار /metrics"""
+    async def handler(method, target, headers, body):
+        if target.split("?", 1)[0] != "/metrics":
+            return 404, "text/plain", b"not found"
+        if method != "GET":
+            return 405, "text/plain", b"method not allowed"
+        return 200, "text/plain; version=0.0.4; charset=utf-8", registry.render().encode("utf-8")
+    return handler
+
+metrics_server = None
+
+async def start_metrics_server():
+    """تشغيل خادم المقاييس إذا تم تحديد METRICS_PORT"""
+    global metrics_server
+    if not METRICS_PORT or metrics_server is not None:
+        return
+    metrics_server = MiniHttpServer(make_metrics_handler(metrics), host=METRICS_LISTEN, port=METRICS_PORT,
+                                    max_connections=10)
+    await metrics_server.start()
+    logger.info(f"المقاييس متاحة على http://{METRICS_LISTEN}:{metrics_server.port}/metrics")
+
+async def stop_metrics_server():
+    global metrics_server
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
+
+async def run_webhook(application):
+    """تشغيل التطبيق بوضع Webhook عبر الخادم المدمج بدلاً من run_polling
+
+    يجب تشغيل نسخة واحدة فقط: المجدول وقيود النقرات وعداداتها في ذاكرة العملية.
+    """
+    path = "/" + WEBHOOK_PATH.strip("/")
+    server = MiniHttpServer(
+        make_webhook_handler(application, path, WEBHOOK_SECRET_TOKEN),
+        host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, max_connections=WEBHOOK_MAX_CONNECTIONS
+    )
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        if WEBHOOK_URL:
+            # تسجيل العنوان العام لدى تيليجرام (قد يكون وكيلاً عكسياً أمام هذه النسخة)
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip("/") + path,
+                secret_token=WEBHOOK_SECRET_TOKEN or None,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+        logger.info(f"وضع Webhook: الاستماع على {WEBHOOK_LISTEN}:{server.port}")
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# اتصالات HTTP المشتركة مع Bot API
+class HttpPoolStats:
+    """عدّ الطلبات والاتصالات الجديدة لمجمع اتصالات عبر event hooks و trace في httpx
+
+    يسجل أيضاً زمن كل استدعاء Bot API حسب اسم الطريقة (من آخر جزء في المسار) حتى وصول
+    ترويسات الاستجابة، فيشمل answerCallbackQuery وتعديل الرسائل وsetWebhook لا طابور الإرسال وحده.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.requests = 0
+        self.connections = 0
+
+    @property
+    def reuse_ratio(self):
+        """نسبة الطلبات التي استخدمت اتصالاً مفتوحاً مسبقاً"""
+        if not self.requests:
+            return 0.0
+        return max(0, self.requests - self.connections) / self.requests
+
+    async def on_request(self, request):
+        self.requests += 1
+        metrics.inc("bot_http_requests_total", pool=self.name)
+        request.extensions["trace"] = self._trace
+        request.extensions["bot_started"] = time.perf_counter()
+
+    async def on_response(self, response):
+        started = response.request.extensions.get("bot_started")
+        if started is not None:
+            method = response.request.url.path.rsplit("/", 1)[-1]
+            metrics.observe("bot_api_call_seconds", time.perf_counter() - started, method=method)
+
+    async def _trace(self, event_name, info):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections += 1
+            metrics.inc("bot_http_connections_opened_total", pool=self.name)
+
+
+http_pool_stats = {}
+
+def make_http_request(name, pool_size=HTTP_POOL_SIZE):
+    """إنشاء مجمع اتصالات HTTPXRequest بالإعدادات المحددة مع تتبع إعادة استخدام الاتصالات"""
+    stats = http_pool_stats[name] = HttpPoolStats(name)
+    options = dict(
+        connection_pool_size=pool_size,
+        connect_timeout=HTTP_CONNECT_TIMEOUT,
+        read_timeout=HTTP_READ_TIMEOUT,
+        write_timeout=HTTP_WRITE_TIMEOUT,
+        pool_timeout=HTTP_POOL_TIMEOUT,
+        httpx_kwargs={
+            "limits": httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            "event_hooks": {"request": [stats.on_request], "response": [stats.on_response]},
+        },
+    )
+    try:
+        return HTTPXRequest(http_version=HTTP_VERSION, **options)
+    except RuntimeError as e:
+        # HTTP/2 غير مثبت: المتابعة بـ HTTP/1.1
+        logger.warning(f"تعذر استخدام HTTP/{HTTP_VERSION} ({e})، سيتم استخدام HTTP/1.1")
+        return HTTPXRequest(http_version="1.1", **options)
+
 
 # وظيفة بدء البوت والمهام
 async def post_init(application: Application):
     """بدء المهام الدورية بعد تهيئة التطبيق"""
     logger.info("البوت قيد التشغيل، بدء المهام الدورية...")
-    config = load_config()
-    for group_id in config["groups"]:
-        await start_periodic_task(application, group_id)
+    outbox.start()
+    totp_engine.start()
+    get_async_store().start()
+    scheduler.start(application)
+    await start_metrics_server()
+    await start_all_periodic_tasks(application)
+    config_reloader.start(application)
 
-def main():
-    """النقطة الرئيسية لتشغيل البوت"""
-    # إنشاء تطبيق البوت
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
+async def post_stop(application: Application):
+    """إيقاف المجدول وتفريغ طابور الإرسال قبل إغلاق اتصال البوت"""
+    await config_reloader.stop()
+    await scheduler.stop()
+    await outbox.stop()
+    await totp_engine.stop()
+    await get_async_store().stop()
+    await stop_metrics_server()
+
+async def post_shutdown(application: Application):
+    """تحرير منفّذ الإدخال/الإخراج عند إيقاف التطبيق"""
+    persistence.shutdown()
+
+def build_application():
+    """إنشاء تطبيق البوت مع جميع المعالجات"""
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        # مجمع واحد لكل استدعاءات API (الأوامر، الطابور الصادر، المجدول)، ومجمع صغير منفصل
+        # لطلبات getUpdates الطويلة حتى لا تحجز اتصالات الإرسال
+        .request(make_http_request("api"))
+        .get_updates_request(make_http_request("updates", pool_size=1))
+        .concurrent_updates(PrioritizedUpdateProcessor(UPDATE_WORKERS, UPDATE_MAX_PENDING))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_BASE_URL:
+        # خادم Bot API بديل (خادم محلي أو خادم اختبار)
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    application = builder.build()
     
     # إنشاء محادثة لوحة الإدارة
     conv_handler = ConversationHandler(
@@ -1281,6 +4132,9 @@ def main():
                 CallbackQueryHandler(add_group, pattern="^add_group$"),
                 CallbackQueryHandler(delete_group, pattern="^delete_group$"),
                 CallbackQueryHandler(edit_group, pattern="^edit_group$"),
+                CallbackQueryHandler(group_health, pattern="^group_health([<>].*)?$"), # العرض والتنقل بين الصفحات
+                CallbackQueryHandler(reset_breaker, pattern="^reset_breaker_"),
+                CallbackQueryHandler(manage_groups, pattern="^manage_groups$"), # زر العودة من حالة الإرسال
                 CallbackQueryHandler(back_to_main, pattern="^back_to_main$")
             ],
             ADD_GROUP: [
@@ -1289,11 +4143,13 @@ def main():
             ],
             DELETE_GROUP: [
                 CallbackQueryHandler(process_delete_group, pattern="^del_group_"),
+                CallbackQueryHandler(delete_group, pattern="^delete_group[<>]"), # التنقل بين الصفحات
                 CallbackQueryHandler(manage_groups, pattern="^manage_groups$"), # زر العودة في هذه القائمة
                 CallbackQueryHandler(back_to_main, pattern="^back_to_main$") # زر العودة للقائمة الرئيسية
             ],
             EDIT_GROUP: [
                 CallbackQueryHandler(process_edit_group, pattern="^edit_group_"),
+                CallbackQueryHandler(edit_group, pattern="^edit_group[<>]"), # التنقل بين الصفحات
                 CallbackQueryHandler(manage_groups, pattern="^manage_groups$"), # زر العودة
                 CallbackQueryHandler(back_to_main, pattern="^back_to_main$")
             ],
@@ -1310,14 +4166,15 @@ def main():
                 CallbackQueryHandler(set_interval, pattern="^set_interval_"),
                 CallbackQueryHandler(set_interval, pattern="^stop_interval$"),
                 CallbackQueryHandler(set_interval, pattern="^start_interval$"),
-                CallbackQueryHandler(manage_interval, pattern="^manage_interval$"), # زر العودة في هذه القائمة
+                CallbackQueryHandler(set_interval, pattern="^toggle_align$"),
+                CallbackQueryHandler(manage_interval, pattern="^manage_interval([<>].*)?$"), # زر العودة والتنقل بين الصفحات
                 CallbackQueryHandler(back_to_main, pattern="^back_to_main$")
             ],
             MANAGE_MESSAGE_STYLE: [
                 CallbackQueryHandler(process_manage_message_style, pattern="^style_"),
                 CallbackQueryHandler(set_message_style, pattern="^set_style_"),
                 CallbackQueryHandler(set_message_style, pattern="^set_timezone_"),
-                CallbackQueryHandler(manage_message_style, pattern="^manage_message_style$"), # زر العودة
+                CallbackQueryHandler(manage_message_style, pattern="^manage_message_style([<>].*)?$"), # زر العودة والتنقل بين الصفحات
                 CallbackQueryHandler(back_to_main, pattern="^back_to_main$")
             ],
             MANAGE_USER_ATTEMPTS: [
@@ -1326,14 +4183,23 @@ def main():
             ],
             SELECT_GROUP_FOR_USER: [
                 CallbackQueryHandler(select_user, pattern="^select_users_"),
+                CallbackQueryHandler(select_group_for_user, pattern="^select_group_for_user[<>]"), # التنقل بين الصفحات
                 CallbackQueryHandler(manage_user_attempts, pattern="^manage_user_attempts$"), # زر العودة
                 CallbackQueryHandler(back_to_main, pattern="^back_to_main$")
             ],
             SELECT_USER: [
                 CallbackQueryHandler(manage_user, pattern="^manage_user_"),
+                CallbackQueryHandler(select_user, pattern="^select_users_"), # التنقل بين الصفحات
+                CallbackQueryHandler(search_user, pattern="^search_user$"),
+                CallbackQueryHandler(user_search_page, pattern="^user_search[<>]"),
                 CallbackQueryHandler(select_group_for_user, pattern="^select_group_for_user$"), # زر العودة
                 CallbackQueryHandler(back_to_main, pattern="^back_to_main$")
             ],
+            SEARCH_USER: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, process_search_user),
+                CallbackQueryHandler(select_user, pattern="^select_users_"), # زر العودة
+                CallbackQueryHandler(cancel, pattern="^cancel$")
+            ],
             MANAGE_USER: [
                 CallbackQueryHandler(add_attempts, pattern="^add_attempts$"),
                 CallbackQueryHandler(remove_attempts, pattern="^remove_attempts$"),
@@ -1380,9 +4246,22 @@ def main():
     # معالج زر النسخ يجب أن يكون خارج المحادثة لأنه يظهر في رسائل المجموعة
     application.add_handler(CallbackQueryHandler(button_callback, pattern="^copy_code_"))
     
+    return application
+
+def main():
+    """النقطة الرئيسية لتشغيل البوت"""
+    application = build_application()
+    
     # تشغيل البوت
     logger.info("بدء تشغيل البوت...")
-    application.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        # ترحيل لمرة واحدة: python3 bot.py migrate
+        migrate_json_to_sqlite()
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+محاكاة المجدول الدوري لـ ChatGPTPlus2FABot على ساعة افتراضية
+
+تستبدل bot.clock بساعة VirtualClock وتقفز مباشرة من موعد إلى الموعد التالي، لذا يمكن
+إعادة تشغيل أسبوع كامل لآلاف المجموعات في ثوانٍ. في النهاية يتم التحقق من:
+- عدد رسائل كل مجموعة يساوي العدد المتوقع من فاصلها الزمني
+- كل رسالة أُرسلت في موعدها الاسمي بالضبط (ضمن --tolerance)
+- إعادة تعيين المحاولات اليومية في handle_copy_code عند منتصف الليل
+
+مثال:
+    python3 simulate.py --groups 10000 --days 7
+    python3 simulate.py --groups 200 --days 2 --mode full
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import datetime
+import itertools
+import tempfile
+import types
+
+# يجب تحديد مجلد البيانات قبل استيراد البوت حتى لا تُمس ملفات الإنتاج
+DATA_DIR = tempfile.mkdtemp(prefix="bot-simulate-")
+os.environ["BOT_DATA_DIR"] = DATA_DIR
+
+import bot  # noqa: E402
+
+# فواصل قائمة "تعديل فترة التكرار" في لوحة الإدارة (عدا الدقيقة والخمس دقائق)
+DEFAULT_INTERVALS = "600,900,1800,3600,10800,43200,86400"
+
+
+class RecordingBot:
+    """بديل لكائن البوت يسجل وقت كل رسالة على الساعة الافتراضية"""
+
+    def __init__(self):
+        self.sent = []  # (الوقت الافتراضي، chat_id، النص)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((bot.clock.time(), chat_id, text))
+        return True
+
+
+class SimulatedQuery:
+    """callback_query مبسط لزر Copy Code يسجل إجابات البوت"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id, group_id):
+        self.id = str(next(self._ids))
+        self.data = f"copy_code_{group_id}"
+        self.from_user = types.SimpleNamespace(id=user_id, first_name="sim")
+        self.answers = []
+
+    async def answer(self, text=None, show_alert=False, **kwargs):
+        self.answers.append(text)
+
+    async def edit_message_reply_markup(self, **kwargs):
+        pass
+
+
+def write_config(group_intervals):
+    config = {"groups": {}, "admins": [bot.ADMIN_ID]}
+    for group_id, interval in group_intervals.items():
+        config["groups"][group_id] = {
+            "totp_secret": "JBSWY3DPEHPK3PXP", "interval": interval, "message_style": 1, "timezone": "UTC"
+        }
+    bot.save_config(config)
+
+
+async def simulate(args):
+    rng = random.Random(args.seed)
+    intervals = [int(x) for x in args.intervals.split(",")]
+    group_intervals = {str(-1000000000000 - i): rng.choice(intervals) for i in range(args.groups)}
+    write_config(group_intervals)
+
+    start = datetime.datetime.fromisoformat(args.start).timestamp()
+    end = start + args.days * 86400
+    bot.clock = bot.VirtualClock(start)
+
+    recording_bot = RecordingBot()
+    fired = {}  # group_id -> [(الوقت الافتراضي، next_send_at)]
+
+    async def record_fire(_bot, group_id, next_send_at=None):
+        fired.setdefault(group_id, []).append((bot.clock.time(), next_send_at))
+
+    if args.mode == "full":
+        async def send(_bot, group_id, next_send_at=None):
+            await record_fire(_bot, group_id, next_send_at)
+            await bot.send_auth_message(_bot, group_id, next_send_at=next_send_at)
+        scheduler = bot.GroupScheduler(send=send)
+    else:
+        scheduler = bot.GroupScheduler(send=record_fire)
+    scheduler.start(types.SimpleNamespace(bot=recording_bot))
+    for group_id, interval in group_intervals.items():
+        scheduler.add(group_id, interval)
+
+    # نقرات يومية لمستخدم واحد: DEFAULT_ATTEMPTS نجاحات ثم استنفاد، وتُعاد في اليوم التالي
+    # (بفاصل دقيقة بين النقرات حتى لا يرفضها حد النقرات)
+    reset_group = next(iter(group_intervals))
+    click_times = [
+        start + day * 86400 + 3600 + n * 60 for day in range(args.days) for n in range(bot.DEFAULT_ATTEMPTS + 1)
+    ]
+    click_results = []
+
+    wall_started = time.perf_counter()
+    while True:
+        await scheduler.wait_idle()
+        deadline = bot.clock.next_deadline()
+        next_click = click_times[0] if click_times else None
+        if next_click is not None and (deadline is None or next_click < deadline):
+            bot.clock.advance_to(click_times.pop(0))
+            context = types.SimpleNamespace(bot=recording_bot, user_data={})
+            query = SimulatedQuery(42, reset_group)
+            await bot.handle_copy_code(types.SimpleNamespace(callback_query=query), context, reset_group)
+            continue
+        if deadline is None or deadline > end:
+            break
+        bot.clock.advance_to(deadline)
+    wall_elapsed = time.perf_counter() - wall_started
+    await scheduler.stop()
+    await bot.get_async_store().stop()
+
+    # التحقق من العدد والدقة لكل مجموعة
+    count_errors = []
+    max_error = 0.0
+    total = 0
+    for group_id, interval in group_intervals.items():
+        events = fired.get(group_id, [])
+        total += len(events)
+        expected = int((end - start) // interval) + 1
+        if len(events) != expected:
+            count_errors.append((group_id, interval, len(events), expected))
+        for k, (fired_at, next_send_at) in enumerate(events):
+            nominal = start + k * interval
+            max_error = max(max_error, abs(fired_at - nominal), abs(next_send_at - (nominal + interval)))
+
+    outcomes = {
+        dict(key)["outcome"]: value for key, value in bot.metrics.sample("bot_copy_code_total").items()
+    }
+    click_results = {
+        "success": outcomes.get("success", 0),
+        "exhausted": outcomes.get("exhausted", 0),
+        "expected_success": args.days * bot.DEFAULT_ATTEMPTS,
+        "expected_exhausted": args.days,
+    }
+
+    return {
+        "groups": args.groups,
+        "virtual_days": args.days,
+        "mode": args.mode,
+        "sends": total,
+        "group_messages": sum(1 for _, chat_id, _ in recording_bot.sent if int(chat_id) < 0),
+        "wall_seconds": round(wall_elapsed, 2),
+        "sends_per_wall_second": round(total / wall_elapsed) if wall_elapsed else 0,
+        "max_timing_error_seconds": max_error,
+        "count_mismatches": len(count_errors),
+        "count_mismatch_examples": count_errors[:5],
+        "daily_reset": click_results,
+        "ok": (not count_errors and max_error <= args.tolerance
+               and click_results["success"] == click_results["expected_success"]
+               and click_results["exhausted"] == click_results["expected_exhausted"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="محاكاة المجدول على ساعة افتراضية")
+    parser.add_argument("--groups", type=int, default=10000, help="عدد المجموعات")
+    parser.add_argument("--days", type=int, default=7, help="عدد الأيام الافتراضية")
+    parser.add_argument("--intervals", default=DEFAULT_INTERVALS, help="فواصل الإرسال (ثوانٍ) مفصولة بفواصل")
+    parser.add_argument("--start", default="2026-01-05T00:00:00", help="بداية الوقت الافتراضي (توقيت محلي)")
+    parser.add_argument("--mode", choices=("fast", "full"), default="fast",
+                        help="fast: المجدول فقط، full: تنفيذ send_auth_message كاملاً")
+    parser.add_argument("--tolerance", type=float, default=1e-6, help="أقصى خطأ زمني مقبول بالثواني")
+    parser.add_argument("--seed", type=int, default=1, help="بذرة العشوائية")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    result = asyncio.run(simulate(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0 if result["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())